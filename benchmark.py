@@ -0,0 +1,435 @@
+import argparse
+import asyncio
+import importlib
+import itertools
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiogram import F, types
+from aiogram.client.session.base import BaseSession
+from aiogram.dispatcher.event.telegram import TelegramEventObserver
+from aiogram.types import InlineKeyboardMarkup
+
+# Нагрузочный прогон диспетчера из main.py без сети: поддельная сессия Bot API,
+# временная БД с синтетическими данными и потоки Update через dp.feed_update.
+# Пример: python benchmark.py --escorts 5000 --updates 2000 --concurrency 100
+# Проверка гонки при захвате заказов: python benchmark.py --join-race --updates 500
+
+ADMIN_ID = 1
+ESCORT_BASE_ID = 1_000_000
+NEW_USER_BASE_ID = 10_000_000
+
+ADMIN_SCREENS = [
+    "📋 Список сквадов",
+    "💰 Балансы сопровождающих",
+    "👥 Пользователи",
+    "📊 Все балансы",
+    "📊 Статистика",
+    "/stats",
+]
+
+class FakeSession(BaseSession):
+    # Отвечает на вызовы Bot API на месте; методы, возвращающие Message, получают правдоподобное сообщение.
+    # Последняя inline-клавиатура каждого чата запоминается, чтобы сценарии могли нажимать её кнопки.
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.last_markup = {}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        chat_id = getattr(method, "chat_id", None) or 0
+        markup = getattr(method, "reply_markup", None)
+        if isinstance(markup, InlineKeyboardMarkup):
+            self.last_markup[chat_id] = markup
+        if method.__returning__ is types.Message:
+            return types.Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=types.Chat(id=chat_id, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+update_ids = itertools.count(1)
+
+def make_user(user_id: int) -> types.User:
+    return types.User(id=user_id, is_bot=False, first_name=f"user{user_id}", username=f"user{user_id}")
+
+def message_update(user_id: int, text: str) -> types.Update:
+    return types.Update(
+        update_id=next(update_ids),
+        message=types.Message(
+            message_id=next(update_ids),
+            date=datetime.now(),
+            chat=types.Chat(id=user_id, type="private"),
+            from_user=make_user(user_id),
+            text=text,
+        ),
+    )
+
+def callback_update(user_id: int, data: str) -> types.Update:
+    message = types.Message(
+        message_id=next(update_ids),
+        date=datetime.now(),
+        chat=types.Chat(id=user_id, type="private"),
+        from_user=make_user(user_id),
+        text="",
+    )
+    return types.Update(
+        update_id=next(update_ids),
+        callback_query=types.CallbackQuery(
+            id=str(next(update_ids)), from_user=make_user(user_id), chat_instance="benchmark", message=message, data=data
+        ),
+    )
+
+async def seed(main, squads: int, escorts: int, orders: int):
+    rng = random.Random(42)
+    squad_rows = []
+    for squad_id in range(1, squads + 1):
+        rating_count = rng.randint(0, 50)
+        rating = float(sum(rng.randint(1, 5) for _ in range(rating_count)))
+        squad_rows.append((f"Squad{squad_id}", rating, rating_count, rating / rating_count if rating_count else 0))
+    escort_rows = [(ADMIN_ID, "admin", "admin_pubg", None, 0, 0, 0.0, 0, 0)]
+    for index in range(escorts):
+        rating_count = rng.randint(0, 20)
+        rating = float(sum(rng.randint(1, 5) for _ in range(rating_count)))
+        escort_rows.append((
+            ESCORT_BASE_ID + index, f"escort{index}", f"pubg{index}", rng.randint(1, squads) if squads else None,
+            rng.randint(0, 50000), rng.randint(0, 100), rating, rating_count, rating / rating_count if rating_count else 0,
+        ))
+    order_rows = [(f"bench{index}", f"Client{index}", rng.randint(500, 5000)) for index in range(orders)]
+    async with main.db.write() as conn:
+        await conn.executemany(
+            "INSERT INTO squads (name, rating, rating_count, avg_rating) VALUES (?, ?, ?, ?)", squad_rows
+        )
+        await conn.executemany(
+            "INSERT INTO escorts (telegram_id, username, pubg_id, squad_id, balance, completed_orders, "
+            "rating, rating_count, avg_rating, rules_accepted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)",
+            escort_rows
+        )
+        await conn.executemany(
+            "INSERT INTO orders (fanpay_order_id, customer_info, amount) VALUES (?, ?, ?)", order_rows
+        )
+        await conn.execute("ANALYZE")
+
+class Recorder:
+    def __init__(self, main):
+        self.main = main
+        self.latencies = []
+
+    async def feed(self, update: types.Update):
+        start = time.perf_counter()
+        await self.main.dp.feed_update(self.main.bot, update)
+        self.latencies.append(time.perf_counter() - start)
+
+def db_totals(main):
+    histograms = [conn.query_histogram for conn in main.metrics.db_connections]
+    return sum(h.sum for h in histograms), sum(sum(h.counts) for h in histograms)
+
+def start_storm(args, recorder, session):
+    return [
+        lambda user_id=NEW_USER_BASE_ID + index: recorder.feed(message_update(user_id, "/start"))
+        for index in range(args.updates)
+    ]
+
+def hot_join(args, recorder, session):
+    # Все нажимают «присоединиться» к нескольким горячим заказам одновременно
+    rng = random.Random(1)
+    hot_orders = list(range(1, min(args.hot_orders, args.orders) + 1))
+    return [
+        lambda user_id=ESCORT_BASE_ID + rng.randrange(args.escorts), order_id=rng.choice(hot_orders):
+            recorder.feed(callback_update(user_id, recorder.main.pack_callback("join", order_id)))
+        for _ in range(args.updates)
+    ]
+
+def leaderboard(args, recorder, session):
+    # Открыть рейтинг и пролистать несколько страниц кнопкой «Вперёд»
+    rng = random.Random(2)
+
+    async def browse(user_id: int, text: str):
+        await recorder.feed(message_update(user_id, text))
+        for _ in range(args.pages - 1):
+            markup = session.last_markup.get(user_id)
+            buttons = [button for row in markup.inline_keyboard for button in row] if markup else []
+            forward = [button for button in buttons if button.callback_data and ":n:" in button.callback_data]
+            if not forward:
+                return
+            await recorder.feed(callback_update(user_id, forward[0].callback_data))
+
+    flows = []
+    for _ in range(max(1, args.updates // args.pages)):
+        user_id = ESCORT_BASE_ID + rng.randrange(args.escorts)
+        text = rng.choice(["🏆 Рейтинг сквадов", "🌟 Рейтинг пользователей"])
+        flows.append(lambda user_id=user_id, text=text: browse(user_id, text))
+    return flows
+
+def admin_lists(args, recorder, session):
+    return [
+        lambda text=ADMIN_SCREENS[index % len(ADMIN_SCREENS)]: recorder.feed(message_update(ADMIN_ID, text))
+        for index in range(args.updates)
+    ]
+
+SCENARIOS = {
+    "start_storm": start_storm,
+    "hot_join": hot_join,
+    "leaderboard": leaderboard,
+    "admin_lists": admin_lists,
+}
+
+async def run_scenario(main, session, name: str, args) -> dict:
+    recorder = Recorder(main)
+    flows = SCENARIOS[name](args, recorder, session)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_flow(flow):
+        async with semaphore:
+            await flow()
+
+    db_time_before, db_queries_before = db_totals(main)
+    api_calls_before = session.calls
+    start = time.perf_counter()
+    await asyncio.gather(*(run_flow(flow) for flow in flows))
+    elapsed = time.perf_counter() - start
+    # Фоновая обработка кнопок, рассылки и outbox не входят в задержку обработчиков,
+    # но завершаются до следующего сценария
+    await main.callback_pipeline.close()
+    await main.lobbies.flush()
+    await main.outbox.drain()
+    await main.broadcaster.close()
+    db_time_after, db_queries_after = db_totals(main)
+
+    latencies = sorted(recorder.latencies)
+    count = len(latencies)
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if count > 1 else latencies * 99
+    return {
+        "scenario": name,
+        "updates": count,
+        "updates_per_sec": count / elapsed if elapsed else 0,
+        "p50_ms": quantiles[49] * 1000 if count else 0,
+        "p99_ms": quantiles[98] * 1000 if count else 0,
+        "db_ms_per_update": (db_time_after - db_time_before) * 1000 / max(count, 1),
+        "queries_per_update": (db_queries_after - db_queries_before) / max(count, 1),
+        "api_calls_per_update": (session.calls - api_calls_before) / max(count, 1),
+    }
+
+def print_report(results):
+    header = f"{'Сценарий':<14}{'Обновл.':>9}{'Обн./с':>10}{'p50 мс':>9}{'p99 мс':>9}{'БД мс/обн.':>12}{'Запр./обн.':>12}{'API/обн.':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['scenario']:<14}{r['updates']:>9}{r['updates_per_sec']:>10.1f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+            f"{r['db_ms_per_update']:>12.3f}{r['queries_per_update']:>12.2f}{r['api_calls_per_update']:>10.2f}"
+        )
+
+async def routing_noop(message: types.Message):
+    return True
+
+def build_routing_observers(main):
+    # Копии обработчиков сообщений из main с пустыми колбэками в порядке регистрации: линейный список
+    # с фильтрами F.text и State (как до TextRoutingObserver) и маршрутизатор со словарями
+    source = main.dp.message
+    states = {state.state: state for state in main.Form.__all_states__}
+    entries = []  # (порядковый номер, тексты кнопки, состояние, исходный обработчик из списка)
+    by_handler = {}
+    for text, (sequence, handler) in source.text_routes.items():
+        by_handler.setdefault(id(handler), (sequence, []))[1].append(text)
+    entries.extend((sequence, texts, None, None) for sequence, texts in by_handler.values())
+    entries.extend((sequence, None, states[state], None) for state, (sequence, _) in source.state_routes.items())
+    entries.extend((sequence, None, None, handler) for sequence, handler in zip(source._sequence, source.handlers))
+    entries.sort(key=lambda entry: entry[0])
+
+    linear = TelegramEventObserver(router=main.dp, event_name="message")
+    routed = main.TextRoutingObserver(router=main.dp, event_name="message")
+    for _, texts, state, handler in entries:
+        if texts is not None:
+            text_filter = F.text == texts[0] if len(texts) == 1 else F.text.in_(texts)
+            linear.register(routing_noop, text_filter)
+            routed.text(*texts)(routing_noop)
+        elif state is not None:
+            linear.register(routing_noop, state)
+            routed.register(routing_noop, state)
+        else:
+            filters = [filter_object.callback for filter_object in handler.filters]
+            linear.register(routing_noop, *filters, flags=handler.flags)
+            routed.register(routing_noop, *filters, flags=handler.flags)
+    return linear, routed
+
+async def run_routing(args):
+    # Микробенчмарк выбора обработчика для нажатия кнопки без middleware, БД и API
+    main = importlib.import_module("main")
+    linear, routed = build_routing_observers(main)
+    texts = list(main.dp.message.text_routes)
+    kwargs = {"bot": main.bot, "raw_state": None}
+    print(f"{'Кнопка':<36}{'Линейно, мкс':>14}{'Словарь, мкс':>14}")
+    totals = [0.0, 0.0]
+    for text in texts:
+        update = message_update(ADMIN_ID, text)
+        timings = []
+        for observer in (linear, routed):
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                await observer.trigger(update.message, **kwargs)
+            timings.append((time.perf_counter() - start) / args.iterations * 1e6)
+        totals[0] += timings[0]
+        totals[1] += timings[1]
+        print(f"{text:<36}{timings[0]:>14.2f}{timings[1]:>14.2f}")
+    print(f"{'Среднее':<36}{totals[0] / len(texts):>14.2f}{totals[1] / len(texts):>14.2f}")
+
+async def run_join_race(args):
+    # Проверка захвата заказов под гонкой через dp: args.updates одновременных нажатий «Готово»
+    # на args.hot_orders заказов, затем каждый присоединившийся одновременно жмёт «Начать выполнение»
+    # args.start_presses раз. На заказ — не больше MAX_PARTICIPANTS заявок и ровно один старт:
+    # заказ в работе, а completed_orders каждого участника вырос ровно на число его начатых заказов.
+    main = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.WARNING)
+    main.bot.session = FakeSession()
+
+    async def press(user_id: int, action: str, order_id: int):
+        await main.dp.feed_update(main.bot, callback_update(user_id, main.pack_callback(action, order_id)))
+
+    await main.db.open()
+    try:
+        await main.init_db()
+        await seed(main, args.squads, args.escorts, args.orders)
+        main.outbox.start()
+        hot_orders = list(range(1, min(args.hot_orders, args.orders) + 1))
+        rng = random.Random(3)
+        await asyncio.gather(*(
+            press(ESCORT_BASE_ID + rng.randrange(args.escorts), "join", rng.choice(hot_orders))
+            for _ in range(args.updates)
+        ))
+        await main.callback_pipeline.close()
+
+        violations = []
+        applications = dict(await main.db.fetchall(
+            "SELECT order_id, COUNT(*) FROM order_applications GROUP BY order_id"
+        ))
+        for order_id in hot_orders:
+            if applications.get(order_id, 0) > main.MAX_PARTICIPANTS:
+                violations.append(f"заказ {order_id}: {applications[order_id]} заявок")
+
+        # В заказ войдут только заявки сквада первого присоединившегося (claim_start)
+        winning = dict(await main.db.fetchall(
+            "SELECT oa.order_id, COUNT(*) FROM order_applications oa WHERE oa.squad_id = ("
+            "SELECT first.squad_id FROM order_applications first WHERE first.order_id = oa.order_id "
+            "ORDER BY first.rowid LIMIT 1) GROUP BY oa.order_id"
+        ))
+        joined = await main.db.fetchall(
+            "SELECT e.telegram_id, oa.order_id FROM order_applications oa JOIN escorts e ON e.id = oa.escort_id"
+        )
+        completed_before = dict(await main.db.fetchall("SELECT id, completed_orders FROM escorts"))
+        await asyncio.gather(*(
+            press(user_id, "start", order_id) for user_id, order_id in joined for _ in range(args.start_presses)
+        ))
+        await main.callback_pipeline.close()
+        await main.lobbies.flush()
+
+        statuses = dict(await main.db.fetchall("SELECT id, status FROM orders"))
+        participants = dict(await main.db.fetchall(
+            "SELECT order_id, COUNT(*) FROM order_escorts GROUP BY order_id"
+        ))
+        expected = {}
+        for escort_id, _ in await main.db.fetchall("SELECT escort_id, order_id FROM order_escorts"):
+            expected[escort_id] = expected.get(escort_id, 0) + 1
+        for escort_id, completed in await main.db.fetchall("SELECT id, completed_orders FROM escorts"):
+            if completed - completed_before[escort_id] != expected.get(escort_id, 0):
+                violations.append(
+                    f"сопровождающий {escort_id}: completed_orders +{completed - completed_before[escort_id]}, "
+                    f"ожидалось +{expected.get(escort_id, 0)}"
+                )
+        print(f"{'Заказ':<8}{'Заявок':>8}{'Из сквада':>11}{'Участников':>12}  Статус")
+        for order_id in hot_orders:
+            print(
+                f"{order_id:<8}{applications.get(order_id, 0):>8}{winning.get(order_id, 0):>11}"
+                f"{participants.get(order_id, 0):>12}  {statuses[order_id]}"
+            )
+            started = statuses[order_id] == "in_progress"
+            if (winning.get(order_id, 0) >= main.MIN_PARTICIPANTS) != started:
+                violations.append(f"заказ {order_id}: {winning.get(order_id, 0)} заявок сквада, статус {statuses[order_id]}")
+            if started and not main.MIN_PARTICIPANTS <= participants.get(order_id, 0) <= main.MAX_PARTICIPANTS:
+                violations.append(f"заказ {order_id}: {participants.get(order_id, 0)} участников")
+        await main.outbox.drain()
+    finally:
+        await main.outbox.close()
+        await main.broadcaster.close()
+        await main.fsm_storage.close()
+        await main.db.close()
+    if violations:
+        print("\n".join(["Нарушения:"] + violations))
+        sys.exit(1)
+    print(f"OK: {args.updates} нажатий «Готово», не больше {main.MAX_PARTICIPANTS} заявок и один старт на заказ")
+
+async def run(args):
+    main = importlib.import_module("main")
+    # Логи обработчиков искажают замеры
+    logging.getLogger().setLevel(logging.WARNING)
+    session = FakeSession()
+    session.middleware(main.ApiMetricsMiddleware())
+    main.bot.session = session
+
+    await main.db.open()
+    try:
+        await main.init_db()
+        await seed(main, args.squads, args.escorts, args.orders)
+        main.outbox.start()
+        results = []
+        for name in args.scenarios:
+            results.append(await run_scenario(main, session, name, args))
+        print_report(results)
+    finally:
+        await main.outbox.close()
+        await main.broadcaster.close()
+        await main.fsm_storage.close()
+        await main.db.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон обработчиков бота без сети")
+    parser.add_argument("--squads", type=int, default=20, help="количество сквадов")
+    parser.add_argument("--escorts", type=int, default=2000, help="количество сопровождающих")
+    parser.add_argument("--orders", type=int, default=200, help="количество заказов в ожидании")
+    parser.add_argument("--hot-orders", type=int, default=3, help="сколько заказов делят между собой нажатия в hot_join")
+    parser.add_argument("--updates", type=int, default=1000, help="обновлений на сценарий")
+    parser.add_argument("--pages", type=int, default=3, help="страниц рейтинга за один просмотр")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременно обрабатываемых потоков")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--db", help="путь к файлу БД (по умолчанию временный, удаляется после прогона)")
+    parser.add_argument("--routing", action="store_true", help="только микробенчмарк выбора обработчика по тексту кнопки")
+    parser.add_argument("--iterations", type=int, default=2000, help="повторов на кнопку в --routing")
+    parser.add_argument("--join-race", action="store_true", help="только проверка лимита участников и единственного старта под гонкой")
+    parser.add_argument("--start-presses", type=int, default=3, help="нажатий «Начать выполнение» на участника в --join-race")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    temp_dir = None
+    if args.db is None:
+        temp_dir = tempfile.mkdtemp(prefix="fanpay_benchmark_")
+        args.db = os.path.join(temp_dir, "benchmark.db")
+    # main читает настройки при импорте, поэтому окружение задаётся до него
+    os.environ["DB_PATH"] = args.db
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    os.environ["ADMIN_IDS"] = str(ADMIN_ID)
+    os.environ.setdefault("BROADCAST_RATE", "1000000")
+    os.environ.setdefault("BROADCAST_CHAT_RATE", "1000000")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        asyncio.run(run_routing(args) if args.routing else run_join_race(args) if args.join_race else run(args))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
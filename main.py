@@ -1,23 +1,42 @@
 import logging
 import aiosqlite
 import asyncio
+import atexit
+import contextvars
+import csv
+import heapq
+import io
+import itertools
+import json
+import sqlite3
 import os
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.fsm.storage.memory import MemoryStorage
+import queue
+import re
+import secrets
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from typing import Any, Dict, Optional
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.dispatcher.event.bases import UNHANDLED, SkipHandler
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.dispatcher.event.telegram import TelegramEventObserver
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.filters import CommandStart, Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiohttp import web
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('bot.log'), logging.StreamHandler()]
-)
-logger = logging.getLogger(__name__)
+from aiohttp import FormData, web
 
 # Переменные окружения
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
@@ -25,6 +44,97 @@ ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "123456789,987654321").spl
 PRIVACY_URL = "https://telegra.ph/Politika-konfidencialnosti-07-19-25"
 RULES_URL = "https://telegra.ph/Pravila-07-19-160"
 DB_PATH = os.getenv("DB_PATH", "fanpay_bot.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))
+ESCORT_CACHE_SIZE = int(os.getenv("ESCORT_CACHE_SIZE", "10000"))
+ESCORT_CACHE_TTL = int(os.getenv("ESCORT_CACHE_TTL", "300"))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "1024"))
+LEADERBOARD_PAGE_SIZE = int(os.getenv("LEADERBOARD_PAGE_SIZE", "20"))
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "30"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CHAT_RATE = float(os.getenv("BROADCAST_CHAT_RATE", "1"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+LOBBY_EDIT_DELAY = float(os.getenv("LOBBY_EDIT_DELAY", "1"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "50"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 60 * 60)))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_CACHE_TTL = int(os.getenv("FSM_CACHE_TTL", "60"))
+# Режим вебхука включается заданием WEBHOOK_URL (публичный адрес за обратным прокси);
+# без него бот работает через long polling
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Настройка логирования
+# Файл и консоль обслуживает поток QueueListener: вызов logger.* в цикле событий
+# только кладёт запись в очередь и не ждёт дискового ввода-вывода.
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json (по строке JSON на запись)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")  # например, midnight; пусто — ротация по размеру
+
+# Контекст текущего обновления: попадает в записи журнала и в статистику запросов к БД
+current_update_id = contextvars.ContextVar("current_update_id", default=None)
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+class LogContextFilter(logging.Filter):
+    # Выполняется в потоке, вызвавшем логгер, пока контекст обновления ещё доступен
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.update_id = current_update_id.get()
+        record.handler = current_handler.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "update_id": getattr(record, "update_id", None),
+            "handler": getattr(record, "handler", None),
+        }, ensure_ascii=False)
+
+def setup_logging() -> QueueListener:
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    else:
+        file_handler = RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [file_handler, logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Остаток очереди дописывается при завершении процесса
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+logger = logging.getLogger(__name__)
 
 # Проверка переменных
 if not BOT_TOKEN:
@@ -40,6 +150,7 @@ MESSAGES = {
     "no_orders": "📋 Сейчас нет доступных заказов.",
     "no_active_orders": "📋 У вас нет активных заказов.",
     "error": "⚠️ Произошла ошибка. Попробуйте снова позже.",
+    "stale_button": "⚠️ Кнопка устарела. Откройте список заказов заново.",
     "invalid_format": "❌ Неверный формат ввода. Попробуйте снова.",
     "order_completed": "✅ Заказ #{order_id} завершен пользователем @{username} (Telegram ID: {telegram_id}, PUBG ID: {pubg_id})!",
     "order_already_completed": "⚠️ Заказ #{order_id} уже завершен.",
@@ -64,9 +175,274 @@ MESSAGES = {
     "rate_order": "🌟 Поставьте оценку за заказ #{order_id} (1-5):"
 }
 
+# --- Клавиатуры ---
+class KeyboardRegistry:
+    # Клавиатуры собираются один раз и переиспользуются; их JSON сериализуется
+    # сессией бота при первой отправке и дальше берётся из кэша.
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._dynamic = OrderedDict()  # ключ -> markup (LRU)
+        self._markups = {}  # id(markup) -> markup
+        self._serialized = {}  # id(markup) -> JSON
+
+    def static(self, markup):
+        self._markups[id(markup)] = markup
+        return markup
+
+    def cached(self, key, factory):
+        markup = self._dynamic.get(key)
+        if markup is not None:
+            self._dynamic.move_to_end(key)
+            return markup
+        markup = self._dynamic[key] = factory()
+        self._markups[id(markup)] = markup
+        while len(self._dynamic) > self.max_size:
+            _, evicted = self._dynamic.popitem(last=False)
+            self._markups.pop(id(evicted), None)
+            self._serialized.pop(id(evicted), None)
+        return markup
+
+    def is_registered(self, markup) -> bool:
+        return self._markups.get(id(markup)) is markup
+
+    def serialized(self, markup, serialize):
+        data = self._serialized.get(id(markup))
+        if data is None:
+            data = self._serialized[id(markup)] = serialize()
+        return data
+
+keyboards = KeyboardRegistry(max_size=KEYBOARD_CACHE_SIZE)
+
+def _build_menu_keyboard(admin: bool):
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [
+                KeyboardButton(text="🏆 Рейтинг сквадов"),
+                KeyboardButton(text="🌟 Рейтинг пользователей")
+            ],
+            [
+                KeyboardButton(text="✅ Завершить заказ"),
+                KeyboardButton(text="📋 Мои заказы")
+            ],
+            [
+                KeyboardButton(text="🔢 Ввести PUBG ID"),
+                KeyboardButton(text="ℹ️ Информация")
+            ],
+            [
+                KeyboardButton(text="👤 Мой профиль"),
+                KeyboardButton(text="📋 Доступные заказы")
+            ],
+            *([[KeyboardButton(text="🔐 Админ-панель")]] if admin else []),
+            [
+                KeyboardButton(text="🔙 На главную")
+            ]
+        ],
+        resize_keyboard=True,
+        one_time_keyboard=False
+    )
+
+MENU_KEYBOARD = keyboards.static(_build_menu_keyboard(admin=False))
+ADMIN_MENU_KEYBOARD = keyboards.static(_build_menu_keyboard(admin=True))
+
+ADMIN_KEYBOARD = keyboards.static(ReplyKeyboardMarkup(
+    keyboard=[
+        [
+            KeyboardButton(text="🏠 Добавить сквад"),
+            KeyboardButton(text="📋 Список сквадов")
+        ],
+        [
+            KeyboardButton(text="👤 Добавить сопровождающего"),
+            KeyboardButton(text="🗑️ Удалить сопровождающего")
+        ],
+        [
+            KeyboardButton(text="💰 Балансы сопровождающих"),
+            KeyboardButton(text="💸 Начислить")
+        ],
+        [
+            KeyboardButton(text="📊 Статистика"),
+            KeyboardButton(text="📝 Добавить заказ")
+        ],
+        [
+            KeyboardButton(text="🚫 Бан навсегда"),
+            KeyboardButton(text="⏰ Бан на время")
+        ],
+        [
+            KeyboardButton(text="⛔ Ограничить"),
+            KeyboardButton(text="👥 Пользователи")
+        ],
+        [
+            KeyboardButton(text="💰 Обнулить баланс"),
+            KeyboardButton(text="📊 Все балансы")
+        ],
+        [
+            KeyboardButton(text="📖 Справочник админ-команд"),
+            KeyboardButton(text="🔙 На главную")
+        ]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+))
+
+RULES_KEYBOARD = keyboards.static(ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="✅ Принять правила")],
+        [KeyboardButton(text="📜 Политика конфиденциальности")],
+        [KeyboardButton(text="📖 Правила")]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+))
+
+INFO_KEYBOARD = keyboards.static(InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📜 Политика конфиденциальности", url=PRIVACY_URL)],
+    [InlineKeyboardButton(text="📖 Правила", url=RULES_URL)]
+]))
+PRIVACY_KEYBOARD = keyboards.static(InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📜 Политика конфиденциальности", url=PRIVACY_URL)]
+]))
+RULES_LINK_KEYBOARD = keyboards.static(InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📖 Правила", url=RULES_URL)]
+]))
+
+def get_menu_keyboard(user_id: int):
+    return ADMIN_MENU_KEYBOARD if is_admin(user_id) else MENU_KEYBOARD
+
+def get_admin_keyboard():
+    return ADMIN_KEYBOARD
+
+def get_rules_keyboard():
+    return RULES_KEYBOARD
+
+# --- Кодек callback-данных кнопок заказов ---
+# Формат: версия (1 символ), опкод (1 символ), аргументы в base36 через точку, например "1r2s.5".
+# Заказ всегда передаётся внутренним id, поэтому fanpay_order_id с любыми символами не ломает разбор,
+# а длина укладывается в 20 байт при лимите Telegram 64.
+CALLBACK_VERSION = "1"
+CALLBACK_MAX_LENGTH = 64
+# опкод -> (действие, имена аргументов)
+CALLBACK_ACTIONS = {
+    "j": ("join", ("order_db_id",)),
+    "s": ("start", ("order_db_id",)),
+    "x": ("cancel", ("order_db_id",)),
+    "c": ("complete", ("order_db_id",)),
+    "r": ("rate", ("order_db_id", "rating")),
+}
+CALLBACK_OPCODES = {action: opcode for opcode, (action, _) in CALLBACK_ACTIONS.items()}
+# Допустимые значения аргументов; не указанные здесь — положительные целые
+CALLBACK_ARG_RANGES = {"rating": range(1, 6)}
+# Кнопки старого формата "<действие>_<id заказа>" в уже отправленных сообщениях
+LEGACY_CALLBACKS = {"join_order": "j", "select_order": "j", "start_order": "s", "cancel_order": "x"}
+# Старые кнопки завершения и оценки несут fanpay_order_id: "complete_order_<id>", "rate_<id>_<оценка>"
+LEGACY_COMPLETE_PREFIX = "complete_order_"
+LEGACY_RATE_PREFIX = "rate_"
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def to_base36(value: int) -> str:
+    digits = ""
+    while True:
+        value, digit = divmod(value, 36)
+        digits = BASE36_DIGITS[digit] + digits
+        if not value:
+            return digits
+
+def pack_callback(action: str, *args: int) -> str:
+    opcode = CALLBACK_OPCODES[action]
+    names = CALLBACK_ACTIONS[opcode][1]
+    if len(args) != len(names):
+        raise ValueError(f"Действие {action} принимает аргументы {names}, передано {len(args)}")
+    data = CALLBACK_VERSION + opcode + ".".join(to_base36(arg) for arg in args)
+    if len(data) > CALLBACK_MAX_LENGTH:
+        raise ValueError(f"callback_data длиннее {CALLBACK_MAX_LENGTH} байт: {data}")
+    return data
+
+def unpack_legacy_callback(data: str):
+    # Для кнопок с fanpay_order_id вместо order_db_id возвращается fanpay_order_id:
+    # внутренний id находит CallbackRoutingObserver перед вызовом обработчика
+    if data.startswith(LEGACY_COMPLETE_PREFIX):
+        fanpay_order_id = data[len(LEGACY_COMPLETE_PREFIX):]
+        return ("c", {"fanpay_order_id": fanpay_order_id}) if fanpay_order_id else None
+    if data.startswith(LEGACY_RATE_PREFIX):
+        fanpay_order_id, _, rating = data[len(LEGACY_RATE_PREFIX):].rpartition("_")
+        if not fanpay_order_id or rating not in ("1", "2", "3", "4", "5"):
+            return None
+        return "r", {"fanpay_order_id": fanpay_order_id, "rating": int(rating)}
+    prefix, _, value = data.rpartition("_")
+    opcode = LEGACY_CALLBACKS.get(prefix)
+    if opcode is None or not value.isascii() or not value.isdigit():
+        return None
+    return opcode, {"order_db_id": int(value)}
+
+def unpack_callback(data: Optional[str]):
+    # Возвращает (опкод, {имя аргумента: значение}) или None, если данные не в формате кодека или неверны
+    if not data or len(data) > CALLBACK_MAX_LENGTH:
+        return None
+    if data[0] != CALLBACK_VERSION:
+        return unpack_legacy_callback(data)
+    spec = CALLBACK_ACTIONS.get(data[1:2])
+    if spec is None:
+        return None
+    parts = data[2:].split(".")
+    if len(parts) != len(spec[1]):
+        return None
+    args = {}
+    for name, part in zip(spec[1], parts):
+        # int(..., 36) пропускает пробелы, знаки и "_" — допускаем только цифры base36
+        if not part or not part.isascii() or not part.isalnum() or part != part.lower():
+            return None
+        value = int(part, 36)
+        if value not in CALLBACK_ARG_RANGES.get(name, range(1, 1 << 63)):
+            return None
+        args[name] = value
+    return data[1], args
+
+def get_order_keyboard(order_db_id: int):
+    return keyboards.cached(("join", order_db_id), lambda: InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Готово", callback_data=pack_callback("join", order_db_id))]
+    ]))
+
+def get_confirmed_order_keyboard(order_db_id: int):
+    return keyboards.cached(("confirmed", order_db_id), lambda: InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Завершить заказ", callback_data=pack_callback("complete", order_db_id))]
+    ]))
+
+def get_lobby_keyboard(order_db_id: int, can_start: bool):
+    def build():
+        rows = [[InlineKeyboardButton(text="Отмена", callback_data=pack_callback("cancel", order_db_id))]]
+        if can_start:
+            rows.insert(0, [InlineKeyboardButton(text="Начать выполнение", callback_data=pack_callback("start", order_db_id))])
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+    return keyboards.cached(("lobby", order_db_id, can_start), build)
+
+def get_rating_keyboard(order_db_id: int):
+    return keyboards.cached(("rating", order_db_id), lambda: InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=f"{rating} ⭐", callback_data=pack_callback("rate", order_db_id, rating))
+            for rating in range(1, 6)
+        ]
+    ]))
+
+class RegistrySession(AiohttpSession):
+    # Для клавиатур из реестра подставляет заранее сериализованный JSON
+    def build_form_data(self, bot: Bot, method):
+        markup = getattr(method, "reply_markup", None)
+        if markup is None or not keyboards.is_registered(markup):
+            return super().build_form_data(bot, method)
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field("reply_markup", keyboards.serialized(
+            markup, lambda: self.prepare_value(markup.model_dump(warnings=False), bot=bot, files=files)
+        ))
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+bot = Bot(token=BOT_TOKEN, session=RegistrySession())
 
 # Состояния FSM
 class Form(StatesGroup):
@@ -78,321 +454,1966 @@ class Form(StatesGroup):
     add_order = State()
     ban_duration = State()
     rate_order = State()
+    import_file = State()
+    ban_permanent = State()
+    restrict_duration = State()
+    remove_escort = State()
+    zero_balance = State()
 
 # --- Веб-обработчик для пинга ---
 async def ping(request):
     return web.Response(text="OK")
 
+# --- Метрики ---
+class Histogram:
+    # Гистограмма с фиксированными границами корзин (формат Prometheus, le — включительно).
+    # Объект создаётся один раз на набор меток, наблюдение не выделяет память.
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+
+    def render(self, name: str, labels: str = "") -> list:
+        prefix = f"{labels}," if labels else ""
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {total}')
+        total += self.counts[-1]
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {total}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {total}")
+        return lines
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOCK_WAIT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+DB_QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+class Metrics:
+    # Счётчики меняются только из цикла событий, поэтому блокировки не нужны.
+    # Гистограммы запросов к БД ведёт каждое соединение в своём потоке; при выдаче они суммируются.
+    def __init__(self):
+        self.updates = {}  # тип обновления -> количество
+        self.handlers = {}  # имя обработчика -> Histogram
+        self.handler_errors = {}  # имя обработчика -> количество
+        self.api_calls = {}  # метод Bot API -> Histogram
+        self.api_errors = {}  # (метод, тип ошибки) -> количество
+        self.db_connections = []  # InstrumentedConnection каждого соединения
+        self.outbox = {}  # результат попытки доставки -> количество
+        # Счётчики строк по состояниям: при старте читаются из БД (init_db), дальше меняются в памяти
+        self.fsm_states = {}  # состояние FSM -> число диалогов, включая ещё не сброшенные в БД
+        self.outbox_rows = {}  # статус строки outbox -> количество
+        self.lobby = {}  # результат обновления сообщения лобби -> количество
+        self.order_lock_wait = Histogram(LOCK_WAIT_BUCKETS)  # ожидание блокировки заказа
+        self.order_lock_contended = 0  # захватов, которым пришлось ждать
+
+    def fsm_state_changed(self, old: Optional[str], new: Optional[str]):
+        if old == new:
+            return
+        if old is not None:
+            self.fsm_states[old] = self.fsm_states.get(old, 0) - 1
+        if new is not None:
+            self.fsm_states[new] = self.fsm_states.get(new, 0) + 1
+
+    def outbox_moved(self, old: Optional[str], new: Optional[str], count: int):
+        if old is not None:
+            self.outbox_rows[old] = self.outbox_rows.get(old, 0) - count
+        if new is not None:
+            self.outbox_rows[new] = self.outbox_rows.get(new, 0) + count
+
+    def handler_histogram(self, name: str) -> Histogram:
+        histogram = self.handlers.get(name)
+        if histogram is None:
+            histogram = self.handlers[name] = Histogram(LATENCY_BUCKETS)
+        return histogram
+
+    def api_histogram(self, method: str) -> Histogram:
+        histogram = self.api_calls.get(method)
+        if histogram is None:
+            histogram = self.api_calls[method] = Histogram(LATENCY_BUCKETS)
+        return histogram
+
+    def render(self, order_locks: int) -> str:
+        lines = ["# TYPE bot_updates_total counter"]
+        for update_type, count in self.updates.items():
+            lines.append(f'bot_updates_total{{type="{update_type}"}} {count}')
+        lines.append("# TYPE bot_handler_duration_seconds histogram")
+        for name, histogram in self.handlers.items():
+            lines.extend(histogram.render("bot_handler_duration_seconds", f'handler="{name}"'))
+        lines.append("# TYPE bot_handler_errors_total counter")
+        for name, count in self.handler_errors.items():
+            lines.append(f'bot_handler_errors_total{{handler="{name}"}} {count}')
+        lines.append("# TYPE bot_db_query_duration_seconds histogram")
+        db_total = Histogram(DB_QUERY_BUCKETS)
+        for conn in self.db_connections:
+            db_total.merge(conn.query_histogram)
+        lines.extend(db_total.render("bot_db_query_duration_seconds"))
+        lines.append("# TYPE bot_telegram_api_duration_seconds histogram")
+        for method, histogram in self.api_calls.items():
+            lines.extend(histogram.render("bot_telegram_api_duration_seconds", f'method="{method}"'))
+        lines.append("# TYPE bot_telegram_api_errors_total counter")
+        for (method, error), count in self.api_errors.items():
+            lines.append(f'bot_telegram_api_errors_total{{method="{method}",error="{error}"}} {count}')
+        lines.append("# TYPE bot_fsm_states gauge")
+        for state, count in self.fsm_states.items():
+            lines.append(f'bot_fsm_states{{state="{state}"}} {count}')
+        lines.append("# TYPE bot_outbox_deliveries_total counter")
+        for result, count in self.outbox.items():
+            lines.append(f'bot_outbox_deliveries_total{{result="{result}"}} {count}')
+        lines.append("# TYPE bot_outbox_messages gauge")
+        for status, count in self.outbox_rows.items():
+            lines.append(f'bot_outbox_messages{{status="{status}"}} {count}')
+        lines.append("# TYPE bot_lobby_edits_total counter")
+        for result, count in self.lobby.items():
+            lines.append(f'bot_lobby_edits_total{{result="{result}"}} {count}')
+        lines.append("# TYPE bot_order_lock_wait_seconds histogram")
+        lines.extend(self.order_lock_wait.render("bot_order_lock_wait_seconds"))
+        lines.append("# TYPE bot_order_lock_contended_total counter")
+        lines.append(f"bot_order_lock_contended_total {self.order_lock_contended}")
+        lines.append("# TYPE bot_order_locks gauge")
+        lines.append(f"bot_order_locks {order_locks}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    # Задержка и ошибки исходящих вызовов Bot API по методам
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            key = (name, type(e).__name__)
+            metrics.api_errors[key] = metrics.api_errors.get(key, 0) + 1
+            raise
+        finally:
+            metrics.api_histogram(name).observe(time.perf_counter() - start)
+
+bot.session.middleware(ApiMetricsMiddleware())
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: types.Update, data: dict):
+        update_type = event.event_type
+        metrics.updates[update_type] = metrics.updates.get(update_type, 0) + 1
+        # До выбора обработчика (проверка доступа, FSM) запросы относятся к типу обновления
+        update_token = current_update_id.set(event.update_id)
+        handler_token = current_handler.set(update_type)
+        try:
+            return await handler(event, data)
+        finally:
+            current_handler.reset(handler_token)
+            current_update_id.reset(update_token)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: вызывается только для сработавшего обработчика
+    async def __call__(self, handler, event, data: dict):
+        name = data["handler"].callback.__name__
+        token = current_handler.set(name)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors[name] = metrics.handler_errors.get(name, 0) + 1
+            raise
+        finally:
+            metrics.handler_histogram(name).observe(time.perf_counter() - start)
+            current_handler.reset(token)
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(len(order_locks)), content_type="text/plain", charset="utf-8")
+
+# --- Пул соединений с базой данных ---
+class QueryStat:
+    # Сводка по одному нормализованному запросу
+    __slots__ = ("sql", "count", "total", "max", "rows", "slow", "sources", "plan")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.slow = 0
+        self.sources = {}  # обработчик -> количество вызовов
+        self.plan = None  # EXPLAIN QUERY PLAN первого медленного выполнения
+
+    def merge(self, other: "QueryStat"):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.rows += other.rows
+        self.slow += other.slow
+        for source, count in other.sources.items():
+            self.sources[source] = self.sources.get(source, 0) + count
+        if self.plan is None:
+            self.plan = other.plan
+
+    @property
+    def flags(self) -> list:
+        # Полные проходы по таблице/индексу и коррелированные подзапросы
+        return [
+            line for line in self.plan or ()
+            if (line.startswith("SCAN ") and line != "SCAN CONSTANT ROW") or line.startswith("CORRELATED ")
+        ]
+
+    def as_dict(self) -> dict:
+        return {
+            "sql": self.sql,
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0,
+            "max_ms": round(self.max * 1000, 3),
+            "rows": self.rows,
+            "slow": self.slow,
+            "sources": self.sources,
+            "plan": self.plan,
+            "flags": self.flags,
+        }
+
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_SPACES = re.compile(r"\s+")
+
+def normalize_sql(sql: str) -> str:
+    return SQL_SPACES.sub(" ", SQL_LITERALS.sub("?", sql)).strip()
+
+class TimedCursor(sqlite3.Cursor):
+    # Время выполнения запроса вместе с выборкой строк. Запрос считается завершённым,
+    # когда строки выбраны до конца, курсор закрыт или на соединении начат следующий запрос.
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._sql = None
+        self._parameters = None
+        self._elapsed = 0.0
+        self._rows = 0
+
+    def _run(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def _begin(self, sql: str, parameters):
+        self._finish()
+        self.connection.begin_statement(self)
+        self._sql = sql
+        self._parameters = parameters
+        self._elapsed = 0.0
+        self._rows = 0
+
+    def _finish(self):
+        if self._sql is None:
+            return
+        sql, self._sql = self._sql, None
+        # Для изменяющих запросов строк не выбирается — учитываем затронутые
+        rows = self._rows or max(self.rowcount, 0)
+        self.connection.end_statement(self, sql, self._parameters, self._elapsed, rows)
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._begin(sql, None)
+        return self._run(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        row = self._run(super().fetchone)
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._run(super().fetchmany, size)
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._run(super().fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Все запросы идут через TimedCursor. Статистику пишет только поток этого соединения,
+    # отчёты суммируют её по всем соединениям.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query_histogram = Histogram(DB_QUERY_BUCKETS)
+        self.query_stats = {}  # нормализованный текст -> QueryStat
+        self._normalized = {}
+        self._pending = None
+        metrics.db_connections.append(self)
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def begin_statement(self, cursor: TimedCursor):
+        # Курсор, брошенный без дочитывания, завершается перед следующим запросом
+        if self._pending is not None and self._pending is not cursor:
+            self._pending._finish()
+        self._pending = cursor
+
+    def end_statement(self, cursor: TimedCursor, sql: str, parameters, elapsed: float, rows: int):
+        if self._pending is cursor:
+            self._pending = None
+        self.query_histogram.observe(elapsed)
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            normalized = normalize_sql(sql)
+            if len(self._normalized) < 1000:
+                self._normalized[sql] = normalized
+        stat = self.query_stats.get(normalized)
+        if stat is None:
+            stat = self.query_stats[normalized] = QueryStat(normalized)
+        # Поток aiosqlite — это сам объект соединения; источник проставляет Database при выдаче
+        source = getattr(threading.current_thread(), "query_source", None) or "-"
+        stat.count += 1
+        stat.total += elapsed
+        stat.max = max(stat.max, elapsed)
+        stat.rows += rows
+        stat.sources[source] = stat.sources.get(source, 0) + 1
+        if elapsed >= SLOW_QUERY_MS / 1000:
+            stat.slow += 1
+            if stat.plan is None and parameters is not None:
+                stat.plan = self.explain(sql, parameters)
+            flags = "; ".join(stat.flags)
+            logger.warning(
+                f"Медленный запрос {elapsed * 1000:.1f} мс ({source}, строк: {rows}): {normalized}"
+                + (f" [{flags}]" if flags else "")
+            )
+
+    def explain(self, sql: str, parameters):
+        try:
+            rows = sqlite3.Connection.execute(self, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error:
+            return []
+        return [row[3] for row in rows]
+
+def query_report() -> list:
+    merged = {}
+    for conn in metrics.db_connections:
+        for stat in list(conn.query_stats.values()):
+            total = merged.get(stat.sql)
+            if total is None:
+                total = merged[stat.sql] = QueryStat(stat.sql)
+            total.merge(stat)
+    return sorted(merged.values(), key=lambda stat: stat.total, reverse=True)
+
+class Database:
+    # Долгоживущие соединения: несколько читателей и один писатель.
+    # Каждое соединение держит собственный кэш подготовленных выражений sqlite3.
+    def __init__(self, path: str, readers: int = 4, cached_statements: int = 256):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self.cached_statements = cached_statements
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._all_readers = []
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._after_commit = []
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(
+            self.path, timeout=30, cached_statements=self.cached_statements, factory=InstrumentedConnection
+        )
+        try:
+            for pragma in DB_PRAGMAS:
+                await conn.execute_fetchall(pragma)
+        except Exception:
+            await conn.close()
+            raise
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        writer = await self._connect()
+        try:
+            # WAL сохраняется в файле БД: читатели не блокируются писателем
+            await writer.execute_fetchall("PRAGMA journal_mode=WAL")
+        except Exception:
+            await writer.close()
+            raise
+        self._writer = writer
+        for _ in range(self.readers_count):
+            conn = await self._connect()
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+        logger.info(f"Пул БД открыт: {self.readers_count} читателей, 1 писатель")
+
+    async def close(self):
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.execute_fetchall("PRAGMA optimize")
+            await self._writer.close()
+            self._writer = None
+        logger.info("Пул БД закрыт")
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._readers.get()
+        conn.query_source = current_handler.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self, immediate: bool = False):
+        # immediate: сразу берём блокировку записи (BEGIN IMMEDIATE), чтобы проверки и изменения
+        # внутри блока не пересекались с писателями из других процессов
+        async with self._write_lock:
+            self._writer.query_source = current_handler.get()
+            try:
+                if immediate:
+                    await self._writer.execute("BEGIN IMMEDIATE")
+                yield self._writer
+            except BaseException:
+                self._after_commit.clear()
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+                callbacks, self._after_commit = self._after_commit, []
+                for callback in callbacks:
+                    callback()
+
+    def after_commit(self, callback):
+        # Вызывается внутри write(): callback выполнится, только если транзакция зафиксирована
+        self._after_commit.append(callback)
+
+    async def fetchone(self, sql: str, params=()):
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, params=()):
+        async with self.read() as conn:
+            return await conn.execute_fetchall(sql, params)
+
+    async def execute(self, sql: str, params=()):
+        async with self.write() as conn:
+            return await conn.execute(sql, params)
+
+DB_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA mmap_size={DB_MMAP_SIZE}",
+    f"PRAGMA cache_size=-{DB_CACHE_KB}",
+    "PRAGMA temp_store=MEMORY",
+]
+
+db = Database(DB_PATH, readers=DB_READERS)
+
+# --- Рассылка уведомлений ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Broadcaster:
+    # Параллельная рассылка с общим лимитом и лимитом на чат (ограничения Telegram).
+    # Сообщения одному чату уходят по порядку, разные чаты обслуживаются параллельно.
+    def __init__(self, rate: float = 25, chat_rate: float = 1, chat_burst: int = 3, max_retries: int = 3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(rate, rate)
+        self._chats = {}
+        self._tasks = set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Полные корзины ничем не отличаются от новых — их можно выбросить
+                idle_before = time.monotonic() - self.chat_burst / self.chat_rate
+                self._chats = {key: value for key, value in self._chats.items() if value.updated > idle_before}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def send(self, chat_id: int, text: str, reply_markup=None, max_retries: Optional[int] = None):
+        # Возвращает None при успехе или последнее исключение
+        error = None
+        if max_retries is None:
+            max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self._global.acquire()
+            try:
+                await bot.send_message(chat_id, text, reply_markup=reply_markup)
+                return None
+            except TelegramRetryAfter as e:
+                error = e
+                if attempt < max_retries:
+                    await asyncio.sleep(e.retry_after)
+            except TelegramNetworkError as e:
+                error = e
+                if attempt < max_retries:
+                    await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                return e
+        return error
+
+    async def _send_chat(self, chat_id: int, items, max_retries: Optional[int]):
+        results = []
+        for index, text, reply_markup in items:
+            error = await self.send(chat_id, text, reply_markup, max_retries)
+            if error is not None:
+                logger.warning(f"Не удалось уведомить {chat_id}: {error}")
+            results.append((index, error))
+        return results
+
+    async def broadcast(self, messages, max_retries: Optional[int] = None):
+        # messages: [(chat_id, text, reply_markup)]; результат: [(chat_id, ошибка или None)] в порядке messages.
+        # max_retries=0 — одна попытка без ожиданий, повтор планирует вызывающий (outbox)
+        messages = list(messages)
+        by_chat = {}
+        for index, (chat_id, text, reply_markup) in enumerate(messages):
+            by_chat.setdefault(chat_id, []).append((index, text, reply_markup))
+        per_chat = await asyncio.gather(
+            *(self._send_chat(chat_id, items, max_retries) for chat_id, items in by_chat.items())
+        )
+        results = [None] * len(messages)
+        for chat_results in per_chat:
+            for index, error in chat_results:
+                results[index] = (messages[index][0], error)
+        return results
+
+    def submit(self, messages) -> asyncio.Task:
+        # Фоновая рассылка: обработчик не ждёт Telegram
+        task = asyncio.create_task(self.broadcast(messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def close(self, timeout: float = 10):
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+broadcaster = Broadcaster(rate=BROADCAST_RATE, chat_rate=BROADCAST_CHAT_RATE)
+
+# --- Очередь уведомлений (outbox) ---
+OUTBOX_MARKUPS = {cls.__name__: cls for cls in (InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove)}
+# Повтор не поможет: бот заблокирован, чат не найден, неверное сообщение
+PERMANENT_SEND_ERRORS = (TelegramForbiddenError, TelegramBadRequest)
+
+def dump_markup(markup):
+    if markup is None:
+        return None
+    return json.dumps({"type": type(markup).__name__, "data": markup.model_dump(exclude_none=True)}, ensure_ascii=False)
+
+def load_markup(data: str):
+    if data is None:
+        return None
+    markup = json.loads(data)
+    return OUTBOX_MARKUPS[markup["type"]].model_validate(markup["data"])
+
+class Outbox:
+    # Уведомления о заказах пишутся в таблицу outbox в той же транзакции, что и смена статуса заказа,
+    # и не теряются при ошибке отправки или перезапуске. Воркер забирает созревшие строки пачками
+    # и отправляет через broadcaster. Временные ошибки повторяются с экспоненциальной задержкой;
+    # постоянные ошибки и исчерпание попыток переводят строку в 'dead'. Доставка — at-least-once:
+    # сообщение, отправленное перед падением процесса, может уйти повторно.
+    def __init__(self, batch_size: int = 100, max_attempts: int = 8, base_delay: float = 5, max_delay: float = 3600,
+                 poll_interval: float = 5, retention: float = 86400):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    async def enqueue(self, conn, key: str, messages):
+        # Вызывается внутри db.write(). key + позиция сообщения образуют dedupe_key:
+        # повторная постановка тех же уведомлений игнорируется.
+        now = time.time()
+        cursor = await conn.executemany(
+            "INSERT INTO outbox (dedupe_key, chat_id, text, reply_markup, next_attempt_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(dedupe_key) DO NOTHING",
+            [
+                (f"{key}:{position}", chat_id, text, dump_markup(reply_markup), now, now)
+                for position, (chat_id, text, reply_markup) in enumerate(messages)
+            ]
+        )
+        inserted = max(cursor.rowcount, 0)
+        db.after_commit(lambda: metrics.outbox_moved(None, "pending", inserted))
+
+    def wake(self):
+        # После коммита: не ждать следующего опроса
+        self._wakeup.set()
+
+    async def deliver(self) -> int:
+        rows = await db.fetchall(
+            "SELECT id, chat_id, text, reply_markup, attempts FROM outbox "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?",
+            (time.time(), self.batch_size)
+        )
+        if not rows:
+            return 0
+        # Одна попытка на строку: медленный чат не задерживает пачку, повтор — через next_attempt_at
+        results = await broadcaster.broadcast(
+            [(chat_id, text, load_markup(reply_markup)) for _, chat_id, text, reply_markup, _ in rows], max_retries=0
+        )
+        now = time.time()
+        sent, retry, dead = [], [], []
+        for (row_id, chat_id, _, _, attempts), (_, error) in zip(rows, results):
+            if error is None:
+                sent.append((now, row_id))
+            elif isinstance(error, PERMANENT_SEND_ERRORS) or attempts + 1 >= self.max_attempts:
+                dead.append((attempts + 1, str(error), now, row_id))
+                logger.error(f"Уведомление {row_id} для {chat_id} не доставлено после {attempts + 1} попыток: {error}")
+            else:
+                delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+                if isinstance(error, TelegramRetryAfter):
+                    delay = max(delay, error.retry_after)
+                retry.append((str(error), now + delay, now, row_id))
+        async with db.write() as conn:
+            await conn.executemany("UPDATE outbox SET status = 'sent', attempts = attempts + 1, updated_at = ? WHERE id = ?", sent)
+            await conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?", retry
+            )
+            await conn.executemany(
+                "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ?, updated_at = ? WHERE id = ?", dead
+            )
+        for result, items in (("sent", sent), ("retry", retry), ("dead", dead)):
+            metrics.outbox[result] = metrics.outbox.get(result, 0) + len(items)
+        metrics.outbox_moved("pending", "sent", len(sent))
+        metrics.outbox_moved("pending", "dead", len(dead))
+        return len(rows)
+
+    async def drain(self):
+        # Отправить всё, что уже созрело
+        while await self.deliver():
+            pass
+
+    async def cleanup(self):
+        # Отправленные строки хранятся retention секунд, чтобы dedupe_key отсекал повторы
+        cursor = await db.execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND updated_at < ?", (time.time() - self.retention,)
+        )
+        metrics.outbox_moved("sent", None, max(cursor.rowcount, 0))
+
+    async def _run(self):
+        current_handler.set("outbox")
+        cleaned_at = 0.0
+        while not self._stopping:
+            delivered = 0
+            try:
+                delivered = await self.deliver()
+                if time.monotonic() - cleaned_at > 3600:
+                    await self.cleanup()
+                    cleaned_at = time.monotonic()
+            except Exception as e:
+                logger.error(f"Ошибка воркера outbox: {e}")
+            # Полная пачка — в очереди, вероятно, есть ещё
+            if delivered < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 10):
+        # Текущая пачка дописывается; неотправленное остаётся в таблице до следующего запуска
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Воркер outbox не завершился вовремя")
+        self._task = None
+
+outbox = Outbox(batch_size=OUTBOX_BATCH_SIZE, max_attempts=OUTBOX_MAX_ATTEMPTS, poll_interval=OUTBOX_POLL_INTERVAL)
+
+# --- Кэш профилей сопровождающих ---
+class EscortCache:
+    # LRU-кэш строк escorts по telegram_id с ограниченным временем жизни.
+    # Любая запись в escorts обязана вызвать invalidate()/invalidate_ids().
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._rows = OrderedDict()  # telegram_id -> (expires_at, row)
+        self._telegram_ids = {}  # escorts.id -> telegram_id
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, telegram_id: int):
+        entry = self._rows.get(telegram_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._drop(telegram_id)
+            self.misses += 1
+            return None
+        self._rows.move_to_end(telegram_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, telegram_id: int, row, generation: int = None):
+        # Строка, прочитанная до инвалидации, не должна попасть в кэш
+        if row is None or (generation is not None and generation != self._generation):
+            return
+        self._rows[telegram_id] = (time.monotonic() + self.ttl, row)
+        self._rows.move_to_end(telegram_id)
+        self._telegram_ids[row[0]] = telegram_id
+        while len(self._rows) > self.max_size:
+            _, (_, evicted_row) = self._rows.popitem(last=False)
+            self._telegram_ids.pop(evicted_row[0], None)
+
+    def invalidate(self, telegram_id: int):
+        self._generation += 1
+        self._drop(telegram_id)
+
+    def invalidate_ids(self, escort_ids):
+        self._generation += 1
+        for escort_id in escort_ids:
+            telegram_id = self._telegram_ids.pop(escort_id, None)
+            if telegram_id is not None:
+                self._rows.pop(telegram_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._rows.clear()
+        self._telegram_ids.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _drop(self, telegram_id: int):
+        entry = self._rows.pop(telegram_id, None)
+        if entry is not None:
+            self._telegram_ids.pop(entry[1][0], None)
+
+escort_cache = EscortCache(max_size=ESCORT_CACHE_SIZE, ttl=ESCORT_CACHE_TTL)
+
+# --- Снимок статистики ---
+class StatsCache:
+    # Общая статистика и статистика сквадов одним снимком: по одному проходу по squads, escorts
+    # и завершённым orders. Снимок живёт ttl секунд; завершение и старт заказа, оценки, балансы
+    # и состав сквадов сбрасывают его через invalidate(). Одновременные запросы ждут один пересчёт.
+    def __init__(self, ttl: float = 30):
+        self.ttl = ttl
+        self._snapshot = None
+        self._expires_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self._generation += 1
+        self._snapshot = None
+
+    def _fresh(self):
+        if self._snapshot is not None and self._expires_at > time.monotonic():
+            self.hits += 1
+            return self._snapshot
+        return None
+
+    async def get(self) -> dict:
+        snapshot = self._fresh()
+        if snapshot is not None:
+            return snapshot
+        async with self._lock:
+            # Пока ждали блокировку, снимок мог пересчитать предыдущий запрос
+            snapshot = self._fresh()
+            if snapshot is not None:
+                return snapshot
+            self.misses += 1
+            generation = self._generation
+            snapshot = await self._compute()
+            # Снимок, посчитанный во время записи, не кэшируется
+            if generation == self._generation:
+                self._snapshot = snapshot
+                self._expires_at = time.monotonic() + self.ttl
+            return snapshot
+
+    async def _compute(self) -> dict:
+        async with db.read() as conn:
+            squads = await conn.execute_fetchall(
+                "SELECT id, name, avg_rating, rating_count FROM squads ORDER BY id"
+            )
+            # Покрывается индексом idx_escorts_squad, таблица escorts не читается
+            members = await conn.execute_fetchall(
+                "SELECT squad_id, COUNT(*), SUM(completed_orders), SUM(balance) FROM escorts GROUP BY squad_id"
+            )
+            completed = await conn.execute_fetchall(
+                "SELECT COUNT(*), SUM(amount), AVG(rating) FROM orders WHERE status = 'completed'"
+            )
+        by_squad = {squad_id: (count, orders or 0, balance or 0) for squad_id, count, orders, balance in members}
+        completed_orders, total_earnings, avg_rating = completed[0]
+        return {
+            "escorts": sum(count for count, _, _ in by_squad.values()),
+            "squads": [
+                (name, *by_squad.get(squad_id, (0, 0, 0)), avg_rating, rating_count)
+                for squad_id, name, avg_rating, rating_count in squads
+            ],
+            "completed_orders": completed_orders,
+            "total_earnings": total_earnings or 0,
+            "avg_rating": avg_rating or 0,
+        }
+
+stats_cache = StatsCache(ttl=STATS_CACHE_TTL)
+
+# --- Сроки банов и ограничений ---
+SANCTIONS = {
+    "ban": {
+        "column": "banned_until",
+        "applied": "🚫 Пользователь {user_id} заблокирован до {date}",
+        "notice": "🚫 Вы заблокированы до {date}",
+        "lifted": "✅ Срок блокировки истёк, доступ восстановлен.",
+    },
+    "restrict": {
+        "column": "restricted_until",
+        "applied": "⛔ Пользователь {user_id} ограничен до {date}",
+        "notice": MESSAGES["user_restricted"],
+        "lifted": "✅ Ограничение снято, сопровождения снова доступны.",
+    },
+}
+
+def format_epoch(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%d.%m.%Y %H:%M")
+
+class SanctionSweeper:
+    # Снимает истёкшие баны и ограничения и сообщает об этом пользователю через outbox.
+    # Сроки лежат в min-куче (срок, telegram_id, вид); задача спит до ближайшего срока,
+    # а schedule() будит её, если новый срок раньше. Записи не удаляются из кучи при изменении
+    # срока: UPDATE сверяет срок с БД, и устаревшая запись просто ничего не меняет.
+    def __init__(self):
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def schedule(self, telegram_id: int, kind: str, until: int):
+        heapq.heappush(self._heap, (until, telegram_id, kind))
+        if self._heap[0][0] == until:
+            self._wakeup.set()
+
+    async def load(self):
+        heap = []
+        for kind, sanction in SANCTIONS.items():
+            column = sanction["column"]
+            rows = await db.fetchall(f"SELECT {column}, telegram_id FROM escorts WHERE {column} IS NOT NULL")
+            heap.extend((until, telegram_id, kind) for until, telegram_id in rows)
+        heapq.heapify(heap)
+        self._heap = heap
+
+    async def sweep(self) -> int:
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        if not due:
+            return 0
+        lifted = []
+        try:
+            async with db.write() as conn:
+                for until, telegram_id, kind in due:
+                    column = SANCTIONS[kind]["column"]
+                    cursor = await conn.execute(
+                        f"UPDATE escorts SET {column} = NULL WHERE telegram_id = ? AND {column} = ?", (telegram_id, until)
+                    )
+                    if cursor.rowcount:
+                        lifted.append((telegram_id, kind))
+                        await outbox.enqueue(
+                            conn, f"sanction:{telegram_id}:{kind}:{until}",
+                            [(telegram_id, SANCTIONS[kind]["lifted"], get_menu_keyboard(telegram_id))]
+                        )
+        except Exception:
+            # Повторить на следующем проходе
+            for item in due:
+                heapq.heappush(self._heap, item)
+            raise
+        if lifted:
+            outbox.wake()
+        for telegram_id, kind in lifted:
+            escort_cache.invalidate(telegram_id)
+            logger.info(f"Снята истёкшая санкция {kind} с пользователя {telegram_id}")
+        return len(lifted)
+
+    async def _run(self):
+        current_handler.set("sanction_sweeper")
+        while not self._stopping:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка очистки истёкших санкций: {e}")
+            self._wakeup.clear()
+            # Сроки хранятся в целых секундах — чаще раза в секунду просыпаться незачем
+            timeout = max(self._heap[0][0] - time.time(), 1) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        await self.load()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+sanction_sweeper = SanctionSweeper()
+
+# --- Хранилище состояний FSM ---
+class SQLiteStorage(BaseStorage):
+    # Состояния диалогов в таблице fsm_states с горячим слоем в памяти.
+    # Изменения копятся в памяти и пишутся пачкой раз в flush_interval секунд (write-behind),
+    # поэтому set_state/clear не ждут коммита. Диалоги, не менявшиеся дольше ttl, удаляются.
+    # cache_ttl ограничивает, насколько устаревшим может быть состояние, изменённое другим процессом.
+    def __init__(self, database: Database, flush_interval: float = 1.0, ttl: float = 86400,
+                 cache_size: int = 10000, cache_ttl: float = 60):
+        self.db = database
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._hot = OrderedDict()  # ключ -> [state, data, expires_at, updated_at]
+        self._dirty = set()
+        self._flush_task = None
+        self._last_sweep = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> tuple:
+        return key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.destiny
+
+    async def _entry(self, key: tuple) -> list:
+        now = time.monotonic()
+        entry = self._hot.get(key)
+        if entry is not None and (key in self._dirty or entry[2] > now):
+            self._hot.move_to_end(key)
+            return entry
+        row = await self.db.fetchone(
+            "SELECT state, data, updated_at FROM fsm_states "
+            "WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ?", key
+        )
+        # Пока шло чтение, состояние могли изменить или загрузить параллельным вызовом:
+        # несохранённая или свежая запись важнее прочитанной, иначе изменения одной из копий потеряются
+        current = self._hot.get(key)
+        if key in self._dirty or (current is not None and current is not entry and current[2] > now):
+            self._hot.move_to_end(key)
+            return current
+        expired = row is not None and row[2] < time.time() - self.ttl
+        if row is None or expired:
+            entry = [None, {}, now + self.cache_ttl, time.time()]
+        else:
+            entry = [row[0], json.loads(row[1]), now + self.cache_ttl, row[2]]
+        self._hot[key] = entry
+        self._hot.move_to_end(key)
+        self._evict()
+        if expired:
+            # Просроченный диалог считается удалённым: строка уйдёт при ближайшем сбросе
+            metrics.fsm_state_changed(row[0], None)
+            self._touch(key, entry)
+        return entry
+
+    def _evict(self):
+        # Вытесняются только сохранённые записи, несохранённые ждут сброса
+        while len(self._hot) > self.cache_size:
+            for key in self._hot:
+                if key not in self._dirty:
+                    del self._hot[key]
+                    break
+            else:
+                return
+
+    def _touch(self, key: tuple, entry: list):
+        entry[3] = time.time()
+        self._dirty.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key = self._key(key)
+        entry = await self._entry(key)
+        state = state.state if isinstance(state, State) else state
+        metrics.fsm_state_changed(entry[0], state)
+        entry[0] = state
+        self._touch(key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        key = self._key(key)
+        entry = await self._entry(key)
+        entry[1] = data.copy()
+        self._touch(key, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._entry(self._key(key)))[1].copy()
+
+    async def _flush_loop(self):
+        current_handler.set("fsm_flush")
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка сброса состояний FSM: {e}")
+
+    async def flush(self):
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for key in keys:
+            entry = self._hot.get(key)
+            if entry is None:
+                continue
+            state, data, _, updated_at = entry
+            if state is None and not data:
+                deletes.append(key)
+            else:
+                upserts.append((*key, state, json.dumps(data, ensure_ascii=False), updated_at))
+        now = time.monotonic()
+        sweep = now - self._last_sweep >= min(self.ttl, 60)
+        try:
+            async with self.db.write() as conn:
+                if upserts:
+                    await conn.executemany(
+                        "INSERT INTO fsm_states (bot_id, chat_id, user_id, thread_id, destiny, state, data, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(bot_id, chat_id, user_id, thread_id, destiny) DO UPDATE SET "
+                        "state = excluded.state, data = excluded.data, updated_at = excluded.updated_at",
+                        upserts
+                    )
+                if deletes:
+                    await conn.executemany(
+                        "DELETE FROM fsm_states "
+                        "WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ?",
+                        deletes
+                    )
+                if sweep:
+                    swept = await conn.execute_fetchall(
+                        "DELETE FROM fsm_states WHERE updated_at < ? RETURNING state", (time.time() - self.ttl,)
+                    )
+                    self.db.after_commit(lambda: [metrics.fsm_state_changed(state, None) for (state,) in swept])
+        except BaseException:
+            # Не сохранённые ключи вернутся в следующий сброс
+            self._dirty |= keys
+            raise
+        if sweep:
+            self._last_sweep = now
+            self._sweep()
+
+    def _sweep(self):
+        # Брошенные диалоги уходят и из горячего слоя
+        cutoff = time.time() - self.ttl
+        expired = [key for key, entry in self._hot.items() if entry[3] < cutoff and key not in self._dirty]
+        for key in expired:
+            del self._hot[key]
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        if self._dirty:
+            await self.flush()
+
+fsm_storage = SQLiteStorage(
+    db, flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_STATE_TTL, cache_size=FSM_CACHE_SIZE, cache_ttl=FSM_CACHE_TTL
+)
+
+# --- Маршрутизация сообщений и callback-запросов ---
+class RoutingObserver(TelegramEventObserver):
+    def has_handlers(self) -> bool:
+        return bool(self.handlers)
+
+    async def _call(self, handler: HandlerObject, event, kwargs, call=None):
+        wrapped_inner = self.outer_middleware.wrap_middlewares(self._resolve_middlewares(), call or handler.call)
+        return await wrapped_inner(event, kwargs)
+
+class TextRoutingObserver(RoutingObserver):
+    # Обработчики кнопок (точный текст) и состояний FSM (единственный фильтр — State) лежат в словарях
+    # текст -> обработчик и состояние -> обработчик. В общем списке aiogram проверял бы их фильтры
+    # по одному, причём синхронные фильтры вроде F.text == ... и State — через пул потоков.
+    # Остальные обработчики (команды) проверяются по списку, но только зарегистрированные раньше
+    # найденного: срабатывает тот же обработчик, что и при линейном обходе.
+    def __init__(self, router, event_name: str):
+        super().__init__(router, event_name)
+        self.text_routes = {}  # текст -> (порядковый номер, обработчик)
+        self.state_routes = {}  # состояние -> (порядковый номер, обработчик)
+        self._sequence = []  # порядковые номера обработчиков из self.handlers
+        self._registered = 0
+
+    def has_handlers(self) -> bool:
+        return bool(self.handlers or self.text_routes or self.state_routes)
+
+    def _next_sequence(self) -> int:
+        self._registered += 1
+        return self._registered
+
+    def register(self, callback, *filters, flags: Optional[Dict[str, Any]] = None, **kwargs):
+        if len(filters) == 1 and isinstance(filters[0], State) and filters[0].state != "*" and not kwargs:
+            handler = HandlerObject(callback=callback, filters=[], flags=flags or {})
+            # Как и в списке, при повторной регистрации срабатывает первый обработчик
+            self.state_routes.setdefault(filters[0].state, (self._next_sequence(), handler))
+            return callback
+        super().register(callback, *filters, flags=flags, **kwargs)
+        self._sequence.append(self._next_sequence())
+        return callback
+
+    def text(self, *texts: str, flags: Optional[Dict[str, Any]] = None):
+        def wrapper(callback):
+            route = (self._next_sequence(), HandlerObject(callback=callback, filters=[], flags=flags or {}))
+            for text in texts:
+                self.text_routes.setdefault(text, route)
+            return callback
+        return wrapper
+
+    async def _trigger_handlers(self, event, kwargs, index: int, before: Optional[int]):
+        # Обработчики списка, начиная с index и зарегистрированные раньше before; возвращает (следующий index, результат)
+        while index < len(self.handlers) and (before is None or self._sequence[index] < before):
+            handler = self.handlers[index]
+            index += 1
+            kwargs["handler"] = handler
+            result, data = await handler.check(event, **kwargs)
+            if result:
+                kwargs.update(data)
+                try:
+                    return index, await self._call(handler, event, kwargs)
+                except SkipHandler:
+                    continue
+        return index, UNHANDLED
+
+    async def trigger(self, event, **kwargs):
+        routes = [
+            route for route in (
+                self.text_routes.get(getattr(event, "text", None)),
+                self.state_routes.get(kwargs.get("raw_state")),
+            ) if route is not None
+        ]
+        routes.sort(key=lambda route: route[0])
+        index = 0
+        for sequence, handler in routes:
+            index, result = await self._trigger_handlers(event, kwargs, index, sequence)
+            if result is not UNHANDLED:
+                return result
+            kwargs["handler"] = handler
+            try:
+                return await self._call(handler, event, kwargs)
+            except SkipHandler:
+                continue
+        _, result = await self._trigger_handlers(event, kwargs, index, None)
+        return result
+
+class CallbackPipeline:
+    # Обработчики кнопок с флагом "ack" работают в два этапа: после проверок middleware callback сразу
+    # получает ответ (значение флага показывается всплывающей подсказкой), а сам обработчик выполняется
+    # фоновой задачей. Изменения одного заказа обработчики выполняют под order_locks: задачи стартуют
+    # в порядке нажатий и первым делом берут блокировку, которая отдаётся ожидающим по очереди.
+    # Ошибка ответа на callback только логируется, необработанная ошибка задачи сообщается пользователю.
+    def __init__(self):
+        self._tasks = set()
+        self._histograms = {}  # обработчик -> гистограмма "<имя>:background", метка строится один раз
+
+    def _histogram(self, handler: HandlerObject) -> Histogram:
+        histogram = self._histograms.get(handler.callback)
+        if histogram is None:
+            histogram = metrics.handler_histogram(f"{handler.callback.__name__}:background")
+            self._histograms[handler.callback] = histogram
+        return histogram
+
+    async def acknowledge(self, event: types.CallbackQuery, **data):
+        handler = data["handler"]
+        toast = handler.flags["ack"]
+        # Задача создаётся до ответа: обработчики стартуют в порядке нажатий, а не завершения ответов
+        task = asyncio.create_task(self._run(handler, event, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        try:
+            await event.answer(toast if isinstance(toast, str) else None)
+        except Exception as e:
+            # Запрос устарел или сеть недоступна — работа всё равно выполняется
+            logger.warning(f"Не удалось ответить на callback от {event.from_user.id}: {e}")
+
+    async def _run(self, handler: HandlerObject, event: types.CallbackQuery, data: dict):
+        user_id = event.from_user.id
+        start = time.perf_counter()
+        try:
+            await handler.call(event, **data)
+        except Exception as e:
+            name = handler.callback.__name__
+            metrics.handler_errors[name] = metrics.handler_errors.get(name, 0) + 1
+            logger.error(f"Ошибка фоновой обработки {name} для {user_id}: {e}")
+            try:
+                await bot.send_message(user_id, MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
+            except Exception as e:
+                logger.warning(f"Не удалось сообщить {user_id} об ошибке: {e}")
+        finally:
+            self._histogram(handler).observe(time.perf_counter() - start)
+
+    async def close(self, timeout: float = 30):
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+callback_pipeline = CallbackPipeline()
+
+class CallbackRoutingObserver(RoutingObserver):
+    # Кнопки заказов разбираются unpack_callback и попадают в обработчик по опкоду из словаря,
+    # аргументы (order_db_id, rating) передаются именованными параметрами. Данные кодека не пересекаются
+    # с префиксами остальных кнопок (lb:, al:), поэтому порядок регистрации на выбор не влияет.
+    # Нераспознанные данные, которые не принял ни один обработчик, получают ответ об устаревшей кнопке.
+    # Обработчики с флагом "ack" выполняются через callback_pipeline.
+    # Старые кнопки с fanpay_order_id получают order_db_id по заказу из БД.
+    def __init__(self, router, event_name: str):
+        super().__init__(router, event_name)
+        self.action_routes = {}  # опкод -> обработчик
+
+    def has_handlers(self) -> bool:
+        return bool(self.handlers or self.action_routes)
+
+    def action(self, action: str, flags: Optional[Dict[str, Any]] = None):
+        def wrapper(callback):
+            self.action_routes.setdefault(
+                CALLBACK_OPCODES[action], HandlerObject(callback=callback, filters=[], flags=flags or {})
+            )
+            return callback
+        return wrapper
+
+    async def trigger(self, event, **kwargs):
+        decoded = unpack_callback(event.data)
+        if decoded is not None:
+            opcode, args = decoded
+            handler = self.action_routes.get(opcode)
+            if handler is not None and "fanpay_order_id" in args:
+                order = await get_order_info(args.pop("fanpay_order_id"))
+                if order is None:
+                    handler = None
+                else:
+                    args["order_db_id"] = order[0]
+            if handler is not None:
+                kwargs.update(args)
+                kwargs["handler"] = handler
+                call = callback_pipeline.acknowledge if "ack" in handler.flags else None
+                try:
+                    return await self._call(handler, event, kwargs, call)
+                except SkipHandler:
+                    pass
+        result = await super().trigger(event, **kwargs)
+        if result is UNHANDLED:
+            logger.warning(f"Нераспознанные callback-данные от {event.from_user.id}: {event.data!r}")
+            await event.answer(MESSAGES["stale_button"], show_alert=True)
+        return result
+
+dp = Dispatcher(storage=fsm_storage)
+dp.message = dp.observers["message"] = TextRoutingObserver(router=dp, event_name="message")
+dp.callback_query = dp.observers["callback_query"] = CallbackRoutingObserver(router=dp, event_name="callback_query")
+
+def used_update_types() -> list:
+    # dp.resolve_used_update_types() смотрит только на observer.handlers, а маршрутизирующие
+    # наблюдатели держат часть обработчиков в своих словарях: список allowed_updates собирается здесь
+    return sorted(
+        name for name, observer in dp.observers.items()
+        if name not in ("update", "error")
+        and (observer.has_handlers() if isinstance(observer, RoutingObserver) else observer.handlers)
+    )
+
+# --- Миграции схемы ---
+# Каждая миграция: (версия, описание, список SQL-выражений). Применяются строго по порядку,
+# каждая в своей транзакции вместе с записью в schema_version.
+MIGRATIONS = [
+    (1, "Базовая схема", [
+        '''
+        CREATE TABLE IF NOT EXISTS squads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            rating REAL DEFAULT 0,
+            rating_count INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS escorts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            pubg_id TEXT,
+            squad_id INTEGER,
+            balance REAL DEFAULT 0,
+            reputation INTEGER DEFAULT 0,
+            completed_orders INTEGER DEFAULT 0,
+            rating REAL DEFAULT 0,
+            rating_count INTEGER DEFAULT 0,
+            is_banned INTEGER DEFAULT 0,
+            ban_until TIMESTAMP,
+            restrict_until TIMESTAMP,
+            rules_accepted INTEGER DEFAULT 0,
+            FOREIGN KEY (squad_id) REFERENCES squads (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fanpay_order_id TEXT UNIQUE NOT NULL,
+            customer_info TEXT,
+            amount REAL,
+            status TEXT DEFAULT 'pending',
+            squad_id INTEGER,
+            completed_at TIMESTAMP,
+            rating INTEGER DEFAULT 0,
+            FOREIGN KEY (squad_id) REFERENCES squads (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS order_escorts (
+            order_id INTEGER,
+            escort_id INTEGER,
+            pubg_id TEXT,
+            PRIMARY KEY (order_id, escort_id),
+            FOREIGN KEY (order_id) REFERENCES orders (id),
+            FOREIGN KEY (escort_id) REFERENCES escorts (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS order_applications (
+            order_id INTEGER,
+            escort_id INTEGER,
+            squad_id INTEGER,
+            pubg_id TEXT,
+            PRIMARY KEY (order_id, escort_id),
+            FOREIGN KEY (order_id) REFERENCES orders (id),
+            FOREIGN KEY (escort_id) REFERENCES escorts (id),
+            FOREIGN KEY (squad_id) REFERENCES squads (id)
+        )
+        ''',
+    ]),
+    (2, "Индексы для горячих запросов", [
+        # available_orders, /stats, complete_order: фильтр по статусу без обращения к таблице
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, amount, rating, fanpay_order_id, customer_info)",
+        # get_squad_escorts, list_squads, проверка баланса сквада, статистика сквадов
+        "CREATE INDEX IF NOT EXISTS idx_escorts_squad ON escorts (squad_id, balance, completed_orders)",
+        # my_orders, complete_order: заказы конкретного сопровождающего
+        "CREATE INDEX IF NOT EXISTS idx_order_escorts_escort ON order_escorts (escort_id, order_id)",
+        "ANALYZE",
+    ]),
+    (3, "Хранимая средняя оценка и индексы рейтингов", [
+        # avg_rating поддерживается триггерами при любом изменении суммы или числа оценок,
+        # поэтому рейтинги и профиль читают готовое значение без деления
+        "ALTER TABLE escorts ADD COLUMN avg_rating REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE squads ADD COLUMN avg_rating REAL NOT NULL DEFAULT 0",
+        "UPDATE escorts SET avg_rating = (CASE WHEN rating_count > 0 THEN rating / rating_count ELSE 0 END)",
+        "UPDATE squads SET avg_rating = (CASE WHEN rating_count > 0 THEN rating / rating_count ELSE 0 END)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_escorts_avg_rating AFTER UPDATE OF rating, rating_count ON escorts
+        BEGIN
+            UPDATE escorts SET avg_rating = CASE WHEN NEW.rating_count > 0 THEN NEW.rating / NEW.rating_count ELSE 0 END
+            WHERE id = NEW.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_squads_avg_rating AFTER UPDATE OF rating, rating_count ON squads
+        BEGIN
+            UPDATE squads SET avg_rating = CASE WHEN NEW.rating_count > 0 THEN NEW.rating / NEW.rating_count ELSE 0 END
+            WHERE id = NEW.id;
+        END
+        ''',
+        # Рейтинги сквадов и сопровождающих читаются в порядке индекса без сортировки
+        "CREATE INDEX IF NOT EXISTS idx_escorts_avg_rating ON escorts (avg_rating DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_squads_avg_rating ON squads (avg_rating DESC, id DESC)",
+    ]),
+    (4, "Хранилище состояний FSM", [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            bot_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            thread_id INTEGER NOT NULL DEFAULT 0,
+            destiny TEXT NOT NULL DEFAULT 'default',
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (bot_id, chat_id, user_id, thread_id, destiny)
+        ) WITHOUT ROWID
+        ''',
+        # Очистка брошенных диалогов по времени последнего изменения
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_at)",
+    ]),
+    (5, "Очередь уведомлений", [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe_key TEXT UNIQUE NOT NULL,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            last_error TEXT
+        )
+        ''',
+        # Выборка созревших сообщений воркером
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending'",
+        # Очистка отправленных и счётчики по статусам для /metrics
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, updated_at)",
+    ]),
+    (6, "Сроки санкций в секундах эпохи", [
+        # Проверка доступа сравнивает целые числа вместо разбора ISO-строк, а частичные индексы
+        # отдают фоновой очистке только действующие сроки
+        "ALTER TABLE escorts ADD COLUMN banned_until INTEGER",
+        "ALTER TABLE escorts ADD COLUMN restricted_until INTEGER",
+        # Старые сроки записаны datetime.now().isoformat(), то есть в локальном времени
+        "UPDATE escorts SET banned_until = CAST(strftime('%s', ban_until, 'utc') AS INTEGER) WHERE ban_until IS NOT NULL",
+        "UPDATE escorts SET restricted_until = CAST(strftime('%s', restrict_until, 'utc') AS INTEGER) WHERE restrict_until IS NOT NULL",
+        "UPDATE escorts SET banned_until = NULL WHERE banned_until <= CAST(strftime('%s', 'now') AS INTEGER)",
+        "UPDATE escorts SET restricted_until = NULL WHERE restricted_until <= CAST(strftime('%s', 'now') AS INTEGER)",
+        "ALTER TABLE escorts DROP COLUMN ban_until",
+        "ALTER TABLE escorts DROP COLUMN restrict_until",
+        "CREATE INDEX idx_escorts_banned_until ON escorts (banned_until) WHERE banned_until IS NOT NULL",
+        "CREATE INDEX idx_escorts_restricted_until ON escorts (restricted_until) WHERE restricted_until IS NOT NULL",
+    ]),
+]
+
 # --- Функции базы данных ---
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.executescript('''
-            CREATE TABLE IF NOT EXISTS squads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                rating REAL DEFAULT 0,
-                rating_count INTEGER DEFAULT 0
-            );
-            CREATE TABLE IF NOT EXISTS escorts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE NOT NULL,
-                username TEXT,
-                pubg_id TEXT,
-                squad_id INTEGER,
-                balance REAL DEFAULT 0,
-                reputation INTEGER DEFAULT 0,
-                completed_orders INTEGER DEFAULT 0,
-                rating REAL DEFAULT 0,
-                rating_count INTEGER DEFAULT 0,
-                is_banned INTEGER DEFAULT 0,
-                ban_until TIMESTAMP,
-                restrict_until TIMESTAMP,
-                rules_accepted INTEGER DEFAULT 0,
-                FOREIGN KEY (squad_id) REFERENCES squads (id)
-            );
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                fanpay_order_id TEXT UNIQUE NOT NULL,
-                customer_info TEXT,
-                amount REAL,
-                status TEXT DEFAULT 'pending',
-                squad_id INTEGER,
-                completed_at TIMESTAMP,
-                rating INTEGER DEFAULT 0,
-                FOREIGN KEY (squad_id) REFERENCES squads (id)
-            );
-            CREATE TABLE IF NOT EXISTS order_escorts (
-                order_id INTEGER,
-                escort_id INTEGER,
-                pubg_id TEXT,
-                PRIMARY KEY (order_id, escort_id),
-                FOREIGN KEY (order_id) REFERENCES orders (id),
-                FOREIGN KEY (escort_id) REFERENCES escorts (id)
-            );
-            CREATE TABLE IF NOT EXISTS order_applications (
-                order_id INTEGER,
-                escort_id INTEGER,
-                squad_id INTEGER,
-                pubg_id TEXT,
-                PRIMARY KEY (order_id, escort_id),
-                FOREIGN KEY (order_id) REFERENCES orders (id),
-                FOREIGN KEY (escort_id) REFERENCES escorts (id),
-                FOREIGN KEY (squad_id) REFERENCES squads (id)
-            );
-        ''')
+    async with db.write() as conn:
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, description TEXT, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        )
         await conn.commit()
-    logger.info("База данных успешно инициализирована")
+        cursor = await conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        current_version = (await cursor.fetchone())[0]
+        for version, description, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+            await conn.execute("BEGIN")
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description)
+            )
+            await conn.commit()
+            current_version = version
+            logger.info(f"Применена миграция {version}: {description}")
+    # Начальные значения счётчиков для /metrics; дальше они меняются в памяти
+    metrics.fsm_states = dict(await db.fetchall(
+        "SELECT state, COUNT(*) FROM fsm_states WHERE state IS NOT NULL GROUP BY state"
+    ))
+    metrics.outbox_rows = dict(await db.fetchall("SELECT status, COUNT(*) FROM outbox GROUP BY status"))
+    logger.info(f"База данных успешно инициализирована (версия схемы {current_version})")
 
 async def get_escort(telegram_id: int):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "SELECT id, squad_id, pubg_id, balance, reputation, completed_orders, username, "
-            "rating, rating_count, is_banned, ban_until, restrict_until, rules_accepted "
-            "FROM escorts WHERE telegram_id = ?", (telegram_id,)
-        )
-        return await cursor.fetchone()
+    escort = escort_cache.get(telegram_id)
+    if escort is not None:
+        return escort
+    generation = escort_cache.generation
+    escort = await db.fetchone(
+        "SELECT id, squad_id, pubg_id, balance, reputation, completed_orders, username, "
+        "avg_rating, rating_count, is_banned, banned_until, restricted_until, rules_accepted "
+        "FROM escorts WHERE telegram_id = ?", (telegram_id,)
+    )
+    escort_cache.put(telegram_id, escort, generation)
+    return escort
 
 async def add_escort(telegram_id: int, username: str):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute(
-            "INSERT OR IGNORE INTO escorts (telegram_id, username, rules_accepted) VALUES (?, ?, 0)",
-            (telegram_id, username)
-        )
-        await conn.commit()
+    await db.execute(
+        "INSERT OR IGNORE INTO escorts (telegram_id, username, rules_accepted) VALUES (?, ?, 0)",
+        (telegram_id, username)
+    )
+    escort_cache.invalidate(telegram_id)
+    stats_cache.invalidate()
     logger.info(f"Добавлен пользователь {telegram_id}")
 
 async def get_squad_escorts(squad_id: int):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "SELECT telegram_id, username, pubg_id, rating FROM escorts WHERE squad_id = ?", (squad_id,)
-        )
-        return await cursor.fetchall()
+    return await db.fetchall(
+        "SELECT telegram_id, username, pubg_id, rating FROM escorts WHERE squad_id = ?", (squad_id,)
+    )
 
 async def get_squad_info(squad_id: int):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            '''
-            SELECT s.name, COUNT(e.id) as member_count,
-                   SUM(e.completed_orders) as total_orders,
-                   SUM(e.balance) as total_balance,
-                   s.rating, s.rating_count
-            FROM squads s
-            LEFT JOIN escorts e ON e.squad_id = s.id
-            WHERE s.id = ?
-            GROUP BY s.id
-            ''', (squad_id,)
-        )
-        return await cursor.fetchone()
+    return await db.fetchone(
+        '''
+        SELECT s.name, COUNT(e.id) as member_count,
+               SUM(e.completed_orders) as total_orders,
+               SUM(e.balance) as total_balance,
+               s.avg_rating, s.rating_count
+        FROM squads s
+        LEFT JOIN escorts e ON e.squad_id = s.id
+        WHERE s.id = ?
+        GROUP BY s.id
+        ''', (squad_id,)
+    )
 
 async def notify_squad(squad_id: int, message: str):
     escorts = await get_squad_escorts(squad_id)
-    for telegram_id, _, _, _ in escorts:
-        try:
-            await bot.send_message(telegram_id, message)
-        except Exception as e:
-            logger.warning(f"Не удалось уведомить {telegram_id}: {e}")
+    return broadcaster.submit([(telegram_id, message, None) for telegram_id, _, _, _ in escorts])
 
-async def notify_admins(message: str, reply_markup=None):
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, message, reply_markup=reply_markup)
-        except Exception as e:
-            logger.warning(f"Не удалось уведомить админа {admin_id}: {e}")
+def admin_messages(message: str, reply_markup=None):
+    return [(admin_id, message, reply_markup) for admin_id in ADMIN_IDS]
+
+def notify_admins(message: str, reply_markup=None):
+    return broadcaster.submit(admin_messages(message, reply_markup))
+
+def format_participants(order_escorts) -> str:
+    return "\n".join(f"👤 @{u or 'Unknown'} (PUBG ID: {p}, Сквад: {s or 'Не назначен'})" for _, u, p, _, s in order_escorts)
+
+def order_started_messages(order_id: str, order_escorts):
+    squad_name = order_escorts[0][4] if order_escorts and order_escorts[0][4] else "Не назначен"
+    return (
+        [(telegram_id, f"📝 Заказ #{order_id} начат! Готовьтесь к сопровождению.", get_menu_keyboard(telegram_id))
+         for telegram_id, _, _, _, _ in order_escorts]
+        + admin_messages(MESSAGES["order_taken"].format(
+            order_id=order_id, squad_name=squad_name, participants=format_participants(order_escorts)
+        ))
+    )
+
+def order_completed_messages(order_db_id: int, order_id: str, admin_message: str, order_escorts):
+    return (
+        admin_messages(admin_message)
+        + [(telegram_id, f"✅ Заказ #{order_id} завершен! Ожидайте оценки.", get_menu_keyboard(telegram_id))
+           for telegram_id, _, _, _, _ in order_escorts]
+        + admin_messages(MESSAGES["rate_order"].format(order_id=order_id), reply_markup=get_rating_keyboard(order_db_id))
+    )
 
 async def get_order_applications(order_id: int):
-    async with aiosqlite.connect(DB_PATH) as conn:
+    return await db.fetchall(
+        '''
+        SELECT e.telegram_id, e.username, e.pubg_id, oa.squad_id, s.name
+        FROM order_applications oa
+        JOIN escorts e ON oa.escort_id = e.id
+        LEFT JOIN squads s ON e.squad_id = s.id
+        WHERE oa.order_id = ?
+        ORDER BY oa.rowid
+        ''', (order_id,)
+    )
+
+async def get_order_info(fanpay_order_id: str):
+    return await db.fetchone(
+        "SELECT id, customer_info, amount, status, squad_id FROM orders WHERE fanpay_order_id = ?",
+        (fanpay_order_id,)
+    )
+
+ORDER_ESCORTS_SQL = '''
+    SELECT e.telegram_id, e.username, oe.pubg_id, e.squad_id, s.name
+    FROM order_escorts oe
+    JOIN escorts e ON oe.escort_id = e.id
+    LEFT JOIN squads s ON e.squad_id = s.id
+    WHERE oe.order_id = ?
+'''
+
+async def get_order_escorts(order_id: int, conn=None):
+    # conn — соединение открытой транзакции, если участники нужны внутри неё
+    if conn is not None:
+        return await conn.execute_fetchall(ORDER_ESCORTS_SQL, (order_id,))
+    return await db.fetchall(ORDER_ESCORTS_SQL, (order_id,))
+
+# --- Блокировки заказов ---
+class KeyedLocks:
+    # asyncio.Lock на ключ: изменения одного заказа выполняются по очереди, разные заказы — параллельно.
+    # Словарь хранит блокировки по слабым ссылкам: блокировка живёт, пока её держат или ждут,
+    # и удаляется сама, когда последняя ссылка пропадает.
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        if lock.locked():
+            metrics.order_lock_contended += 1
+        start = time.perf_counter()
+        async with lock:
+            metrics.order_lock_wait.observe(time.perf_counter() - start)
+            yield
+
+order_locks = KeyedLocks()
+
+# --- Захват заказов ---
+# Проверка и изменение выполняются одним условным выражением внутри BEGIN IMMEDIATE,
+# поэтому одновременные нажатия не могут превысить лимит участников или начать заказ дважды.
+MIN_PARTICIPANTS = 2
+MAX_PARTICIPANTS = 4
+# Вместимость сквада
+MAX_SQUAD_MEMBERS = 6
+
+async def claim_join(order_db_id: int, escort_id: int, squad_id, pubg_id: str) -> str:
+    # Возвращает "joined", "closed" (заказ не в наборе), "duplicate" или "full"
+    async with db.write(immediate=True) as conn:
         cursor = await conn.execute(
             '''
-            SELECT e.telegram_id, e.username, e.pubg_id, e.squad_id, s.name
-            FROM order_applications oa
-            JOIN escorts e ON oa.escort_id = e.id
-            LEFT JOIN squads s ON e.squad_id = s.id
-            WHERE oa.order_id = ?
-            ''', (order_id,)
+            INSERT INTO order_applications (order_id, escort_id, squad_id, pubg_id)
+            SELECT ?, ?, ?, ?
+            WHERE EXISTS (SELECT 1 FROM orders WHERE id = ? AND status = 'pending')
+              AND (SELECT COUNT(*) FROM order_applications WHERE order_id = ?) < ?
+            ON CONFLICT(order_id, escort_id) DO NOTHING
+            ''', (order_db_id, escort_id, squad_id, pubg_id, order_db_id, order_db_id, MAX_PARTICIPANTS)
         )
-        return await cursor.fetchall()
+        if cursor.rowcount == 1:
+            return "joined"
+        # Вставка не прошла: выясняем причину в той же транзакции
+        async with conn.execute("SELECT status FROM orders WHERE id = ?", (order_db_id,)) as cursor:
+            order = await cursor.fetchone()
+        if not order or order[0] != "pending":
+            return "closed"
+        async with conn.execute(
+            "SELECT 1 FROM order_applications WHERE order_id = ? AND escort_id = ?", (order_db_id, escort_id)
+        ) as cursor:
+            if await cursor.fetchone():
+                return "duplicate"
+        return "full"
+
+async def claim_start(order_db_id: int):
+    # Возвращает (статус, fanpay_order_id, участники); статус "started", "closed", "participants" или "no_squad".
+    # Уведомления о старте ставятся в outbox той же транзакцией.
+    async with db.write(immediate=True) as conn:
+        async with conn.execute(
+            "SELECT fanpay_order_id FROM orders WHERE id = ? AND status = 'pending'", (order_db_id,)
+        ) as cursor:
+            order = await cursor.fetchone()
+        if not order:
+            return "closed", None, []
+        applications = await conn.execute_fetchall(
+            "SELECT escort_id, squad_id, pubg_id FROM order_applications WHERE order_id = ? ORDER BY rowid",
+            (order_db_id,)
+        )
+        if not applications:
+            return "participants", order[0], []
+
+        # Сквад первого присоединившегося считается победившим
+        winning_squad_id = applications[0][1]
+        valid_applications = [app for app in applications if app[1] == winning_squad_id]
+        if not valid_applications:
+            return "no_squad", order[0], []
+        # Минимум и максимум считаются по участникам, которые действительно войдут в заказ
+        if not MIN_PARTICIPANTS <= len(valid_applications) <= MAX_PARTICIPANTS:
+            return "participants", order[0], []
 
-async def get_order_info(fanpay_order_id: str):
-    async with aiosqlite.connect(DB_PATH) as conn:
         cursor = await conn.execute(
-            "SELECT id, customer_info, amount, status, squad_id FROM orders WHERE fanpay_order_id = ?",
-            (fanpay_order_id,)
+            "UPDATE orders SET status = 'in_progress', squad_id = ? WHERE id = ? AND status = 'pending'",
+            (winning_squad_id, order_db_id)
         )
-        return await cursor.fetchone()
-
-async def update_escort_reputation(escort_id: int, rating: int):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute(
-            '''
-            UPDATE escorts SET reputation = reputation + ?, rating = rating + ?, rating_count = rating_count + 1
-            WHERE id = ?
-            ''', (rating, rating, escort_id)
+        if cursor.rowcount != 1:
+            return "closed", order[0], []
+
+        # Перенос только участников из победившего сквада в order_escorts
+        await conn.executemany(
+            "INSERT INTO order_escorts (order_id, escort_id, pubg_id) VALUES (?, ?, ?) "
+            "ON CONFLICT(order_id, escort_id) DO NOTHING",
+            [(order_db_id, escort_id, pubg_id) for escort_id, _, pubg_id in valid_applications]
         )
-        await conn.commit()
+        await conn.executemany(
+            "UPDATE escorts SET completed_orders = completed_orders + 1 WHERE id = ?",
+            [(escort_id,) for escort_id, _, _ in valid_applications]
+        )
+        await conn.execute("DELETE FROM order_applications WHERE order_id = ?", (order_db_id,))
+        order_escorts = await get_order_escorts(order_db_id, conn)
+        await outbox.enqueue(conn, f"order:{order_db_id}:started", order_started_messages(order[0], order_escorts))
+    outbox.wake()
+    escort_cache.invalidate_ids([escort_id for escort_id, _, _ in valid_applications])
+    stats_cache.invalidate()
+    return "started", order[0], order_escorts
+
+async def claim_complete(order_db_id: int, escort: tuple, telegram_id: int, check: str):
+    # Возвращает (статус, текст): "completed" и уведомление о завершении либо статус отказа и текст для ответа.
+    # check: "participant" — завершает только участник заказа (кнопка), "balance" — баланс сквада должен
+    # покрывать сумму заказа (ввод ID). Ответ отправляет обработчик уже после транзакции.
+    async with db.write() as conn:
+        order = await conn.execute_fetchall(
+            "SELECT fanpay_order_id, squad_id, amount, status FROM orders WHERE id = ?", (order_db_id,)
+        )
+        if not order or order[0][3] != "in_progress":
+            return "closed", MESSAGES["order_already_completed"].format(order_id=order[0][0] if order else order_db_id)
+        order_id, squad_id, amount, _ = order[0]
+
+        if check == "participant":
+            rows = await conn.execute_fetchall(
+                "SELECT COUNT(*) FROM order_escorts WHERE order_id = ? AND escort_id = ?",
+                (order_db_id, escort[0])
+            )
+            if rows[0][0] == 0:
+                return "not_participant", "⚠️ Вы не участвуете в этом заказе."
+        else:
+            # Проверка, начислен ли баланс (простая проверка для админов)
+            rows = await conn.execute_fetchall("SELECT SUM(balance) FROM escorts WHERE squad_id = ?", (squad_id,))
+            total_balance = rows[0][0] or 0
+            if total_balance < amount:
+                return "low_balance", (
+                    f"⚠️ Общий баланс сквада ({total_balance:.2f} руб.) меньше суммы заказа ({amount:.2f} руб.). "
+                    "Обратитесь к администратору."
+                )
 
-async def update_squad_reputation(squad_id: int, rating: int):
-    async with aiosqlite.connect(DB_PATH) as conn:
         await conn.execute(
-            '''
-            UPDATE squads SET rating = rating + ?, rating_count = rating_count + 1
-            WHERE id = ?
-            ''', (rating, squad_id)
+            "UPDATE orders SET status = 'completed', completed_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (order_db_id,)
         )
-        await conn.commit()
-
-async def get_order_escorts(order_id: int):
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            '''
-            SELECT e.telegram_id, e.username, oe.pubg_id, e.squad_id, s.name
-            FROM order_escorts oe
-            JOIN escorts e ON oe.escort_id = e.id
-            LEFT JOIN squads s ON e.squad_id = s.id
-            WHERE oe.order_id = ?
-            ''', (order_id,)
+        # Уведомление админов, участников и запрос оценки — через outbox в той же транзакции
+        completed_message = MESSAGES["order_completed"].format(
+            order_id=order_id, username=escort[6] or "Unknown", telegram_id=telegram_id, pubg_id=escort[2] or "Не указан"
         )
-        return await cursor.fetchall()
+        participants = await get_order_escorts(order_db_id, conn)
+        await outbox.enqueue(conn, f"order:{order_db_id}:completed", order_completed_messages(order_db_id, order_id, completed_message, participants))
+    outbox.wake()
+    stats_cache.invalidate()
+    return "completed", completed_message
+
+# --- Сообщения лобби заказа ---
+def format_lobby(order_db_id: int, applications):
+    participants = "\n".join(f"👤 @{u or 'Unknown'} (PUBG ID: {p}, Сквад: {s or 'Не назначен'})" for _, u, p, _, s in applications)
+    response = f"📋 Заказ #{order_db_id} в ожидании:\nУчастники:\n{participants if participants else 'Пока никто не присоединился'}\nУчастников: {len(applications)}/{MAX_PARTICIPANTS}"
+    # Кнопка начала появляется, когда достаточно участников из сквада первого присоединившегося —
+    # только они войдут в заказ (claim_start)
+    winning = [app for app in applications if app[3] == applications[0][3]] if applications else []
+    return response, len(winning) >= MIN_PARTICIPANTS
+
+class LobbyRenderer:
+    # Сообщения лобби (участники заказа и кнопки) правятся не на каждое нажатие, а не чаще раза
+    # в delay секунд на заказ: нажатия внутри окна сливаются в одну правку. Обновляются все сообщения,
+    # из которых нажимали кнопки этого заказа; сообщение с тем же содержимым не редактируется.
+    # Нажатие во время правки запускает ещё один проход, поэтому последнее состояние всегда доходит.
+    def __init__(self, delay: float = 1):
+        self.delay = delay
+        self._views = {}  # id заказа -> {(chat_id, message_id): хэш показанного содержимого}
+        self._dirty = set()  # заказы, изменившиеся после последней отрисовки
+        self._tasks = {}  # id заказа -> задача отложенной отрисовки
+
+    def update(self, order_db_id: int, message: types.Message):
+        self._views.setdefault(order_db_id, {}).setdefault((message.chat.id, message.message_id), None)
+        self._dirty.add(order_db_id)
+        if order_db_id not in self._tasks:
+            self._tasks[order_db_id] = asyncio.create_task(self._run(order_db_id))
+
+    async def _run(self, order_db_id: int):
+        current_handler.set("lobby")
+        try:
+            while order_db_id in self._dirty:
+                await asyncio.sleep(self.delay)
+                self._dirty.discard(order_db_id)
+                try:
+                    await self.render(order_db_id)
+                except asyncio.CancelledError:
+                    self._dirty.add(order_db_id)
+                    raise
+        except Exception as e:
+            logger.error(f"Ошибка обновления лобби заказа #{order_db_id}: {e}")
+        finally:
+            self._tasks.pop(order_db_id, None)
 
-# --- Проверка админских прав ---
-def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+    def _count(self, result: str):
+        metrics.lobby[result] = metrics.lobby.get(result, 0) + 1
 
-# --- Клавиатуры ---
-def get_menu_keyboard(user_id: int):
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="🏆 Рейтинг сквадов"),
-                KeyboardButton(text="🌟 Рейтинг пользователей")
-            ],
-            [
-                KeyboardButton(text="✅ Завершить заказ"),
-                KeyboardButton(text="📋 Мои заказы")
-            ],
-            [
-                KeyboardButton(text="🔢 Ввести PUBG ID"),
-                KeyboardButton(text="ℹ️ Информация")
-            ],
-            [
-                KeyboardButton(text="👤 Мой профиль"),
-                KeyboardButton(text="📋 Доступные заказы")
-            ],
-            [
-                KeyboardButton(text="🔐 Админ-панель")
-            ] if is_admin(user_id) else [],
-            [
-                KeyboardButton(text="🔙 На главную")
-            ]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False
-    )
-    return keyboard
+    async def render(self, order_db_id: int):
+        views = self._views.get(order_db_id)
+        if not views:
+            return
+        order = await db.fetchone("SELECT status FROM orders WHERE id = ?", (order_db_id,))
+        if not order or order[0] != "pending":
+            # Заказ начат или удалён: сообщение лобби больше не ведём
+            self._views.pop(order_db_id, None)
+            return
+        text, can_start = format_lobby(order_db_id, await get_order_applications(order_db_id))
+        digest = hash((text, can_start))
+        for view, shown in list(views.items()):
+            if shown == digest:
+                self._count("unchanged")
+                continue
+            chat_id, message_id = view
+            while True:
+                try:
+                    await bot.edit_message_text(
+                        text, chat_id=chat_id, message_id=message_id, reply_markup=get_lobby_keyboard(order_db_id, can_start)
+                    )
+                    views[view] = digest
+                    self._count("edited")
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except TelegramBadRequest as e:
+                    if "message is not modified" in str(e):
+                        views[view] = digest
+                        self._count("unchanged")
+                    else:
+                        # Сообщение удалено или недоступно
+                        views.pop(view, None)
+                        self._count("failed")
+                except Exception as e:
+                    logger.warning(f"Не удалось обновить лобби заказа #{order_db_id} в чате {chat_id}: {e}")
+                    self._count("failed")
+                break
+
+    async def close_order(self, order_db_id: int):
+        # Заказ покинул лобби: отложенная правка не должна перезаписать новое сообщение
+        task = self._tasks.get(order_db_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._dirty.discard(order_db_id)
+        self._views.pop(order_db_id, None)
+
+    async def flush(self):
+        # Немедленная отрисовка всех отложенных изменений
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for order_db_id in list(self._dirty):
+            self._dirty.discard(order_db_id)
+            try:
+                await self.render(order_db_id)
+            except Exception as e:
+                logger.error(f"Ошибка обновления лобби заказа #{order_db_id}: {e}")
 
-def get_admin_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="🏠 Добавить сквад"),
-                KeyboardButton(text="📋 Список сквадов")
-            ],
-            [
-                KeyboardButton(text="👤 Добавить сопровождающего"),
-                KeyboardButton(text="🗑️ Удалить сопровождающего")
-            ],
-            [
-                KeyboardButton(text="💰 Балансы сопровождающих"),
-                KeyboardButton(text="💸 Начислить")
-            ],
-            [
-                KeyboardButton(text="📊 Статистика"),
-                KeyboardButton(text="📝 Добавить заказ")
-            ],
-            [
-                KeyboardButton(text="🚫 Бан навсегда"),
-                KeyboardButton(text="⏰ Бан на время")
-            ],
-            [
-                KeyboardButton(text="⛔ Ограничить"),
-                KeyboardButton(text="👥 Пользователи")
-            ],
-            [
-                KeyboardButton(text="💰 Обнулить баланс"),
-                KeyboardButton(text="📊 Все балансы")
-            ],
-            [
-                KeyboardButton(text="📖 Справочник админ-команд"),
-                KeyboardButton(text="🔙 На главную")
-            ]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False
-    )
-    return keyboard
+lobbies = LobbyRenderer(delay=LOBBY_EDIT_DELAY)
 
-def get_rules_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="✅ Принять правила")],
-            [KeyboardButton(text="📜 Политика конфиденциальности")],
-            [KeyboardButton(text="📖 Правила")]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-    return keyboard
-
-def get_order_keyboard(order_id: str):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Готово", callback_data=f"join_order_{order_id}")]
-    ])
-    return keyboard
-
-def get_confirmed_order_keyboard(order_id: str):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Завершить заказ", callback_data=f"complete_order_{order_id}")]
-    ])
-    return keyboard
-
-def get_rating_keyboard(order_id: str):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="1 ⭐", callback_data=f"rate_{order_id}_1"),
-            InlineKeyboardButton(text="2 ⭐", callback_data=f"rate_{order_id}_2"),
-            InlineKeyboardButton(text="3 ⭐", callback_data=f"rate_{order_id}_3"),
-            InlineKeyboardButton(text="4 ⭐", callback_data=f"rate_{order_id}_4"),
-            InlineKeyboardButton(text="5 ⭐", callback_data=f"rate_{order_id}_5")
-        ]
-    ])
-    return keyboard
+# --- Проверка админских прав ---
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_IDS
 
 # --- Проверка доступа ---
-async def check_access(message: types.Message, initial_start: bool = False):
-    user_id = message.from_user.id
-    try:
-        escort = await get_escort(user_id)
-        if not escort:
-            await add_escort(user_id, message.from_user.username or "Unknown")
-            escort = await get_escort(user_id)
-
-        if escort[9]:  # is_banned
-            await message.answer(MESSAGES["user_banned"], reply_markup=ReplyKeyboardRemove())
-            return False
-        if escort[10] and datetime.fromisoformat(escort[10]) > datetime.now():  # ban_until
-            await message.answer(MESSAGES["user_banned"], reply_markup=ReplyKeyboardRemove())
-            return False
-        if escort[11] and datetime.fromisoformat(escort[11]) > datetime.now():  # restrict_until
-            await message.answer(MESSAGES["user_restricted"].format(date=escort[11]), reply_markup=ReplyKeyboardRemove())
-            return False
-        if not escort[12] and initial_start:  # rules_accepted
-            await message.answer(MESSAGES["rules_not_accepted"], reply_markup=get_rules_keyboard())
-            return False
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка в check_access для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=ReplyKeyboardRemove())
+async def check_access(user: types.User, initial_start: bool = False):
+    # Возвращает (профиль, текст отказа, клавиатура); текст None означает, что доступ разрешён
+    escort = await get_escort(user.id)
+    if not escort:
+        await add_escort(user.id, user.username or "Unknown")
+        escort = await get_escort(user.id)
+
+    now = time.time()
+    if escort[9]:  # is_banned
+        return escort, MESSAGES["user_banned"], ReplyKeyboardRemove()
+    if escort[10] and escort[10] > now:  # banned_until
+        return escort, MESSAGES["user_banned"], ReplyKeyboardRemove()
+    if escort[11] and escort[11] > now:  # restricted_until
+        return escort, MESSAGES["user_restricted"].format(date=format_epoch(escort[11])), ReplyKeyboardRemove()
+    if not escort[12] and initial_start:  # rules_accepted
+        return escort, MESSAGES["rules_not_accepted"], get_rules_keyboard()
+    return escort, None, None
+
+def is_start_command(event) -> bool:
+    if not isinstance(event, types.Message) or not event.text:
         return False
+    return event.text.split(maxsplit=1)[0].split("@", 1)[0] == "/start"
+
+class AccessMiddleware(BaseMiddleware):
+    # Внешний middleware: один раз на апдейт загружает профиль, проверяет бан,
+    # ограничение и принятие правил, передаёт в обработчики escort и role.
+    def __init__(self):
+        self.checks = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        started = time.perf_counter()
+        try:
+            escort, denial, reply_markup = await check_access(user, initial_start=is_start_command(event))
+        except Exception as e:
+            logger.error(f"Ошибка в check_access для {user.id}: {e}")
+            escort, denial, reply_markup = None, MESSAGES["error"], ReplyKeyboardRemove()
+        finally:
+            elapsed = time.perf_counter() - started
+            self.checks += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+        if denial is not None:
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(denial, show_alert=True)
+            else:
+                await event.answer(denial, reply_markup=reply_markup)
+            return None
+
+        data["escort"] = escort
+        data["role"] = "admin" if is_admin(user.id) else "escort"
+        return await handler(event, data)
+
+class AdminMiddleware(BaseMiddleware):
+    # Внутренний middleware: обработчики с флагом admin_only доступны только админам
+    async def __call__(self, handler, event, data):
+        if get_flag(data, "admin_only") and data.get("role") != "admin":
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(MESSAGES["no_access"], show_alert=True)
+            else:
+                await event.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(event.from_user.id))
+            return None
+        return await handler(event, data)
+
+access_middleware = AccessMiddleware()
+dp.message.outer_middleware(access_middleware)
+dp.callback_query.outer_middleware(access_middleware)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.message.middleware(AdminMiddleware())
+dp.callback_query.middleware(AdminMiddleware())
 
 # --- Обработчики ---
 @dp.message(CommandStart())
@@ -400,8 +2421,6 @@ async def cmd_start(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
     try:
-        if not await check_access(message, initial_start=True):
-            return
         await message.answer(f"{MESSAGES['welcome']}\n📌 Выберите действие:", reply_markup=get_menu_keyboard(user_id))
         logger.info(f"Пользователь {user_id} (@{username}) запустил бота")
     except Exception as e:
@@ -412,23 +2431,20 @@ async def cmd_start(message: types.Message):
 async def cmd_ping(message: types.Message):
     await message.answer(MESSAGES["ping"], reply_markup=get_menu_keyboard(message.from_user.id))
 
-@dp.message(F.text == "✅ Принять правила")
+@dp.message.text("✅ Принять правила")
 async def accept_rules(message: types.Message):
     user_id = message.from_user.id
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute("UPDATE escorts SET rules_accepted = 1 WHERE telegram_id = ?", (user_id,))
-            await conn.commit()
+        await db.execute("UPDATE escorts SET rules_accepted = 1 WHERE telegram_id = ?", (user_id,))
+        escort_cache.invalidate(user_id)
         await message.answer(f"✅ Правила приняты! Добро пожаловать!\n📌 Выберите действие:", reply_markup=get_menu_keyboard(user_id))
         logger.info(f"Пользователь {user_id} принял правила")
     except Exception as e:
         logger.error(f"Ошибка в accept_rules для {user_id}: {e}")
         await message.answer(MESSAGES["error"], reply_markup=ReplyKeyboardRemove())
 
-@dp.message(F.text == "🔢 Ввести PUBG ID")
+@dp.message.text("🔢 Ввести PUBG ID")
 async def enter_pubg_id(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
     await message.answer("🔢 Введите ваш PUBG ID:", reply_markup=ReplyKeyboardRemove())
     await state.set_state(Form.pubg_id)
 
@@ -441,12 +2457,11 @@ async def process_pubg_id(message: types.Message, state: FSMContext):
         await state.clear()
         return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute(
-                "UPDATE escorts SET pubg_id = ? WHERE telegram_id = ?",
-                (pubg_id, user_id)
-            )
-            await conn.commit()
+        await db.execute(
+            "UPDATE escorts SET pubg_id = ? WHERE telegram_id = ?",
+            (pubg_id, user_id)
+        )
+        escort_cache.invalidate(user_id)
         await message.answer(MESSAGES["pubg_id_updated"], reply_markup=get_menu_keyboard(user_id))
         logger.info(f"Пользователь {user_id} обновил PUBG ID: {pubg_id}")
     except Exception as e:
@@ -455,56 +2470,34 @@ async def process_pubg_id(message: types.Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.message(F.text == "ℹ️ Информация")
+@dp.message.text("ℹ️ Информация")
 async def info_handler(message: types.Message):
-    if not await check_access(message):
-        return
     try:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📜 Политика конфиденциальности", url=PRIVACY_URL)],
-            [InlineKeyboardButton(text="📖 Правила", url=RULES_URL)]
-        ])
         response = "ℹ️ Информация о боте:"
-        await message.answer(response, reply_markup=keyboard)
+        await message.answer(response, reply_markup=INFO_KEYBOARD)
     except Exception as e:
         logger.error(f"Ошибка в info_handler: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(message.from_user.id))
 
-@dp.message(F.text.in_(["📜 Политика конфиденциальности", "📖 Правила"]))
+@dp.message.text("📜 Политика конфиденциальности", "📖 Правила")
 async def rules_links(message: types.Message):
-    if not await check_access(message):
-        return
     try:
         if message.text == "📜 Политика конфиденциальности":
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📜 Политика конфиденциальности", url=PRIVACY_URL)]
-            ])
-            await message.answer("📜 Политика конфиденциальности:", reply_markup=keyboard)
+            await message.answer("📜 Политика конфиденциальности:", reply_markup=PRIVACY_KEYBOARD)
         else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📖 Правила", url=RULES_URL)]
-            ])
-            await message.answer("📖 Правила:", reply_markup=keyboard)
+            await message.answer("📖 Правила:", reply_markup=RULES_LINK_KEYBOARD)
     except Exception as e:
         logger.error(f"Ошибка в rules_links: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(message.from_user.id))
 
-@dp.message(F.text == "👤 Мой профиль")
-async def my_profile(message: types.Message):
-    if not await check_access(message):
-        return
+@dp.message.text("👤 Мой профиль")
+async def my_profile(message: types.Message, escort: tuple):
     user_id = message.from_user.id
     try:
-        escort = await get_escort(user_id)
-        if not escort:
-            await add_escort(user_id, message.from_user.username or "Unknown")
-            escort = await get_escort(user_id)
-
-        escort_id, squad_id, pubg_id, balance, reputation, completed_orders, username, rating, rating_count, _, ban_until, restrict_until, _ = escort
-        async with aiosqlite.connect(DB_PATH) as conn:
+        escort_id, squad_id, pubg_id, balance, reputation, completed_orders, username, avg_rating, rating_count, _, _, _, _ = escort
+        async with db.read() as conn:
             cursor = await conn.execute("SELECT name FROM squads WHERE id = ?", (squad_id,))
             squad = await cursor.fetchone()
-        avg_rating = rating / rating_count if rating_count > 0 else 0
         response = (
             f"👤 Ваш профиль:\n"
             f"🔹 Username: @{username or 'Unknown'}\n"
@@ -520,12 +2513,10 @@ async def my_profile(message: types.Message):
         logger.error(f"Ошибка в my_profile: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
 
-@dp.message(F.text == "📋 Доступные заказы")
+@dp.message.text("📋 Доступные заказы")
 async def available_orders(message: types.Message):
-    if not await check_access(message):
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with db.read() as conn:
             cursor = await conn.execute(
                 "SELECT id, fanpay_order_id, customer_info, amount FROM orders WHERE status = 'pending'"
             )
@@ -536,7 +2527,7 @@ async def available_orders(message: types.Message):
             return
 
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=f"#{order_id} - {customer}, {amount:.2f} руб.", callback_data=f"select_order_{db_id}")]
+            [InlineKeyboardButton(text=f"#{order_id} - {customer}, {amount:.2f} руб.", callback_data=pack_callback("join", db_id))]
             for db_id, order_id, customer, amount in orders
         ])
         await message.answer("📋 Доступные заказы:", reply_markup=keyboard)
@@ -544,307 +2535,120 @@ async def available_orders(message: types.Message):
         logger.error(f"Ошибка в available_orders: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(message.from_user.id))
 
-@dp.callback_query(F.data.startswith("select_order_"))
-async def select_order(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    try:
-        order_db_id = int(callback.data.split("_")[-1])
-        await callback.answer()
-        # Перенаправление на join_order для обработки
-        await join_order(callback)
-    except Exception as e:
-        logger.error(f"Ошибка в select_order для {user_id}: {e}")
-        await callback.message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
-        await callback.answer()
+JOIN_REFUSALS = {
+    "closed": MESSAGES["order_already_in_progress"],
+    "duplicate": "⚠️ Вы уже присоединились к этому заказу!",
+    "full": MESSAGES["max_participants"],
+}
+
+START_REFUSALS = {
+    "closed": MESSAGES["order_already_in_progress"],
+    "participants": "⚠️ Для начала выполнения нужно 2-4 участника!",
+    "no_squad": "⚠️ Не удалось определить сквад для заказа.",
+}
 
-@dp.callback_query(F.data.startswith("join_order_"))
-async def join_order(callback: types.CallbackQuery):
+@dp.callback_query.action("join", flags={"ack": "⏳ Присоединяем к заказу…"})
+async def join_order(callback: types.CallbackQuery, escort: tuple, order_db_id: int):
     user_id = callback.from_user.id
     try:
-        escort = await get_escort(user_id)
-        if not escort:
-            await callback.message.answer("⚠️ Ваш профиль не найден. Обратитесь к администратору.", reply_markup=get_menu_keyboard(user_id))
-            await callback.answer()
-            return
         if not escort[2]:  # pubg_id
             await callback.message.answer("⚠️ Укажите ваш PUBG ID!", reply_markup=get_menu_keyboard(user_id))
-            await callback.answer()
             return
 
         escort_id = escort[0]
         pubg_id = escort[2]
-        order_db_id = int(callback.data.split("_")[-1])
 
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT status, squad_id FROM orders WHERE id = ?", (order_db_id,))
-            order = await cursor.fetchone()
-            if not order or order[0] != "pending":
-                await callback.message.answer(MESSAGES["order_already_in_progress"], reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-
-            cursor = await conn.execute(
-                "SELECT COUNT(*) FROM order_applications WHERE order_id = ? AND escort_id = ?",
-                (order_db_id, escort_id)
-            )
-            if (await cursor.fetchone())[0] > 0:
-                await callback.message.answer("⚠️ Вы уже присоединились к этому заказу!", reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-
-            cursor = await conn.execute(
-                "SELECT COUNT(*) FROM order_applications WHERE order_id = ?", (order_db_id,)
-            )
-            participant_count = (await cursor.fetchone())[0]
-            if participant_count >= 4:  # Максимум 4 участника
-                await callback.message.answer(MESSAGES["max_participants"], reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-
-            await conn.execute(
-                "INSERT INTO order_applications (order_id, escort_id, squad_id, pubg_id) VALUES (?, ?, ?, ?) "
-                "ON CONFLICT(order_id, escort_id) DO NOTHING",
-                (order_db_id, escort_id, escort[1], pubg_id)
-            )
-            await conn.commit()
-
-        # Обновление сообщения с участниками
-        applications = await get_order_applications(order_db_id)
-        participants = "\n".join(f"👤 @{u or 'Unknown'} (PUBG ID: {p}, Сквад: {s or 'Не назначен'})" for _, u, p, _, s in applications)
-        response = f"📋 Заказ #{order_db_id} в ожидании:\nУчастники:\n{participants if participants else 'Пока никто не присоединился'}\nУчастников: {len(applications)}/4"
-        
-        # Проверка, достаточно ли участников для начала
-        if len(applications) >= 2:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Начать выполнение", callback_data=f"start_order_{order_db_id}")],
-                [InlineKeyboardButton(text="Отмена", callback_data=f"cancel_order_{order_db_id}")]
-            ])
-            await callback.message.edit_text(response, reply_markup=keyboard)
-        else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Отмена", callback_data=f"cancel_order_{order_db_id}")]
-            ])
-            await callback.message.edit_text(response, reply_markup=keyboard)
+        async with order_locks.hold(order_db_id):
+            result = await claim_join(order_db_id, escort_id, escort[1], pubg_id)
+        if result != "joined":
+            await callback.message.answer(JOIN_REFUSALS[result], reply_markup=get_menu_keyboard(user_id))
+            return
 
-        await callback.answer()
+        # Сообщение с участниками обновится с остальными нажатиями по этому заказу
+        lobbies.update(order_db_id, callback.message)
 
     except aiosqlite.IntegrityError as e:
         logger.error(f"Ошибка целостности данных в join_order для {user_id}: {e}")
         await callback.message.answer("⚠️ Ошибка данных. Обратитесь к администратору.", reply_markup=get_menu_keyboard(user_id))
-        await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в join_order для {user_id}: {e}")
         await callback.message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
-        await callback.answer()
 
-@dp.callback_query(F.data.startswith("start_order_"))
-async def start_order(callback: types.CallbackQuery):
+@dp.callback_query.action("start", flags={"ack": "⏳ Запускаем заказ…"})
+async def start_order(callback: types.CallbackQuery, escort: tuple, order_db_id: int):
     user_id = callback.from_user.id
     try:
-        order_db_id = int(callback.data.split("_")[-1])
-        escort = await get_escort(user_id)
-        if not escort or not escort[1]:  # Проверка профиля и сквада
-            await callback.message.answer("⚠️ Ваш профиль не найден или вы не в скваде.", reply_markup=get_menu_keyboard(user_id))
-            await callback.answer()
+        if not escort[1]:  # Проверка сквада
+            await callback.message.answer(MESSAGES["not_in_squad"], reply_markup=get_menu_keyboard(user_id))
             return
 
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT fanpay_order_id, status FROM orders WHERE id = ?", (order_db_id,)
-            )
-            order = await cursor.fetchone()
-            if not order or order[1] != "pending":
-                await callback.message.answer(MESSAGES["order_already_in_progress"], reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-
-            cursor = await conn.execute(
-                "SELECT escort_id, squad_id, pubg_id FROM order_applications WHERE order_id = ?", (order_db_id,)
-            )
-            applications = await cursor.fetchall()
-            if len(applications) < 2 or len(applications) > 4:
-                await callback.message.answer("⚠️ Для начала выполнения нужно 2-4 участника!", reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-
-            # Определяем сквад первого участника как победивший
-            winning_squad_id = applications[0][1]  # Сквад первого, кто присоединился
-            valid_applications = [app for app in applications if app[1] == winning_squad_id]
-
-            if not valid_applications:
-                await callback.message.answer("⚠️ Не удалось определить сквад для заказа.", reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-
-            # Перенос только участников из победившего сквада в order_escorts
-            for escort_id, _, pubg_id in valid_applications:
-                await conn.execute(
-                    "INSERT INTO order_escorts (order_id, escort_id, pubg_id) VALUES (?, ?, ?) "
-                    "ON CONFLICT(order_id, escort_id) DO NOTHING",
-                    (order_db_id, escort_id, pubg_id)
-                )
-                await conn.execute(
-                    "UPDATE escorts SET completed_orders = completed_orders + 1 WHERE id = ?",
-                    (escort_id,)
-                )
-            await conn.execute(
-                "UPDATE orders SET status = 'in_progress', squad_id = ? WHERE id = ?",
-                (winning_squad_id, order_db_id)
-            )
-            await conn.execute("DELETE FROM order_applications WHERE order_id = ?", (order_db_id,))
-            await conn.commit()
+        # Участников и админов уведомляет outbox
+        async with order_locks.hold(order_db_id):
+            result, order_id, order_escorts = await claim_start(order_db_id)
+        if result != "started":
+            await callback.message.answer(START_REFUSALS[result], reply_markup=get_menu_keyboard(user_id))
+            return
 
         # Обновление сообщения с новыми данными
-        order_id = order[0]
-        participants = "\n".join(f"👤 @{u or 'Unknown'} (PUBG ID: {p}, Сквад: {s or 'Не назначен'})" for _, u, p, _, s in await get_order_escorts(order_db_id))
-        response = MESSAGES["order_confirmed"].format(order_id=order_id, participants=participants)
-        keyboard = get_confirmed_order_keyboard(order_id)
+        await lobbies.close_order(order_db_id)
+        response = MESSAGES["order_confirmed"].format(order_id=order_id, participants=format_participants(order_escorts))
+        keyboard = get_confirmed_order_keyboard(order_db_id)
         await callback.message.edit_text(response, reply_markup=keyboard)
 
-        # Уведомление участников
-        for telegram_id, _, _, _, _ in await get_order_escorts(order_db_id):
-            await bot.send_message(telegram_id, f"📝 Заказ #{order_id} начат! Готовьтесь к сопровождению.", reply_markup=get_menu_keyboard(telegram_id))
-
-        # Уведомление админов
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT name FROM squads WHERE id = ?", (winning_squad_id,))
-            squad_name = (await cursor.fetchone())[0] or "Не назначен"
-        await notify_admins(MESSAGES["order_taken"].format(order_id=order_id, squad_name=squad_name, participants=participants))
-
-        await callback.answer()
-
     except Exception as e:
         logger.error(f"Ошибка в start_order для {user_id}: {e}")
         await callback.message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
-        await callback.answer()
 
-@dp.callback_query(F.data.startswith("complete_order_"))
-async def complete_order_callback(callback: types.CallbackQuery):
+@dp.callback_query.action("complete", flags={"ack": "⏳ Завершаем заказ…"})
+async def complete_order_callback(callback: types.CallbackQuery, escort: tuple, order_db_id: int):
     user_id = callback.from_user.id
-    order_id = callback.data.split("_")[-1]
     try:
-        escort = await get_escort(user_id)
-        if not escort:
-            await callback.message.answer("⚠️ Ваш профиль не найден.", reply_markup=get_menu_keyboard(user_id))
-            await callback.answer()
+        async with order_locks.hold(order_db_id):
+            result, response = await claim_complete(order_db_id, escort, user_id, "participant")
+        if result != "completed":
+            await callback.message.answer(response, reply_markup=get_menu_keyboard(user_id))
             return
-        escort_id = escort[0]
-        username = escort[6] or "Unknown"
-        pubg_id = escort[2] or "Не указан"
 
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT id, squad_id, amount FROM orders WHERE fanpay_order_id = ? AND status = 'in_progress'",
-                (order_id,)
-            )
-            order = await cursor.fetchone()
-            if not order:
-                await callback.message.answer(MESSAGES["order_already_completed"], reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-            order_db_id, squad_id, amount = order
-
-            cursor = await conn.execute(
-                "SELECT COUNT(*) FROM order_escorts WHERE order_id = ? AND escort_id = ?",
-                (order_db_id, escort_id)
-            )
-            if (await cursor.fetchone())[0] == 0:
-                await callback.message.answer("⚠️ Вы не участвуете в этом заказе.", reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-
-            await conn.execute(
-                "UPDATE orders SET status = 'completed', completed_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (order_db_id,)
-            )
-            await conn.commit()
-
-        await callback.message.edit_text(MESSAGES["order_completed"].format(order_id=order_id, username=username, telegram_id=user_id, pubg_id=pubg_id), reply_markup=None)
-        admin_message = MESSAGES["order_completed"].format(order_id=order_id, username=username, telegram_id=user_id, pubg_id=pubg_id)
-        await notify_admins(admin_message)
-
-        # Уведомление всех участников о завершении заказа
-        participants = await get_order_escorts(order_db_id)
-        for telegram_id, _, _, _, _ in participants:
-            try:
-                await bot.send_message(telegram_id, f"✅ Заказ #{order_id} завершен! Ожидайте оценки.", reply_markup=get_menu_keyboard(telegram_id))
-            except Exception as e:
-                logger.warning(f"Не удалось уведомить {telegram_id} о завершении заказа: {e}")
-
-        # Уведомление админов с запросом оценки
-        rating_keyboard = get_rating_keyboard(order_id)
-        await notify_admins(MESSAGES["rate_order"].format(order_id=order_id), reply_markup=rating_keyboard)
-
-        await callback.answer()
+        await callback.message.edit_text(response, reply_markup=None)
 
     except Exception as e:
         logger.error(f"Ошибка в complete_order_callback для {user_id}: {e}")
         await callback.message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
-        await callback.answer()
 
-@dp.callback_query(F.data.startswith("cancel_order_"))
-async def cancel_order(callback: types.CallbackQuery):
+@dp.callback_query.action("cancel", flags={"ack": "⏳ Отменяем участие…"})
+async def cancel_order(callback: types.CallbackQuery, order_db_id: int):
     user_id = callback.from_user.id
     try:
-        order_db_id = int(callback.data.split("_")[-1])
-        await callback.answer()
-
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT escort_id FROM order_applications WHERE order_id = ? AND escort_id = (SELECT id FROM escorts WHERE telegram_id = ?)",
-                (order_db_id, user_id)
-            )
-            escort = await cursor.fetchone()
-            if not escort:
-                await callback.message.answer("⚠️ Вы не участвуете в этом заказе.", reply_markup=get_menu_keyboard(user_id))
-                return
-
-            await conn.execute(
-                "DELETE FROM order_applications WHERE order_id = ? AND escort_id = (SELECT id FROM escorts WHERE telegram_id = ?)",
-                (order_db_id, user_id)
-            )
-            await conn.commit()
+        async with order_locks.hold(order_db_id):
+            async with db.write() as conn:
+                cursor = await conn.execute(
+                    "DELETE FROM order_applications WHERE order_id = ? AND escort_id = (SELECT id FROM escorts WHERE telegram_id = ?)",
+                    (order_db_id, user_id)
+                )
+                removed = cursor.rowcount
+        if not removed:
+            await callback.message.answer("⚠️ Вы не участвуете в этом заказе.", reply_markup=get_menu_keyboard(user_id))
+            return
 
-        applications = await get_order_applications(order_db_id)
-        participants = "\n".join(f"👤 @{u or 'Unknown'} (PUBG ID: {p}, Сквад: {s or 'Не назначен'})" for _, u, p, _, s in applications)
-        response = f"📋 Заказ #{order_db_id} в ожидании:\nУчастники:\n{participants if participants else 'Пока никто не присоединился'}\nУчастников: {len(applications)}/4"
-        
-        if len(applications) >= 2:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Начать выполнение", callback_data=f"start_order_{order_db_id}")],
-                [InlineKeyboardButton(text="Отмена", callback_data=f"cancel_order_{order_db_id}")]
-            ])
-            await callback.message.edit_text(response, reply_markup=keyboard)
-        else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Отмена", callback_data=f"cancel_order_{order_db_id}")]
-            ])
-            await callback.message.edit_text(response, reply_markup=keyboard)
+        lobbies.update(order_db_id, callback.message)
 
     except Exception as e:
         logger.error(f"Ошибка в cancel_order для {user_id}: {e}")
         await callback.message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
 
-@dp.message(F.text == "📋 Мои заказы")
-async def my_orders(message: types.Message):
-    if not await check_access(message):
-        return
+@dp.message.text("📋 Мои заказы")
+async def my_orders(message: types.Message, escort: tuple):
     user_id = message.from_user.id
     try:
-        escort = await get_escort(user_id)
-        if not escort:
-            await message.answer("⚠️ Ваш профиль не найден.", reply_markup=get_menu_keyboard(user_id))
-            return
         escort_id = escort[0]
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with db.read() as conn:
             cursor = await conn.execute(
                 '''
                 SELECT o.fanpay_order_id, o.customer_info, o.amount, o.status
-                FROM orders o
-                JOIN order_escorts oe ON o.id = oe.order_id
-                JOIN escorts e ON oe.escort_id = e.id
-                WHERE e.telegram_id = ?
-                ''', (user_id,)
+                FROM order_escorts oe
+                JOIN orders o ON o.id = oe.order_id
+                WHERE oe.escort_id = ?
+                ''', (escort_id,)
             )
             orders = await cursor.fetchall()
 
@@ -861,26 +2665,19 @@ async def my_orders(message: types.Message):
         logger.error(f"Ошибка в my_orders: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
 
-@dp.message(F.text == "✅ Завершить заказ")
-async def complete_order(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
+@dp.message.text("✅ Завершить заказ")
+async def complete_order(message: types.Message, state: FSMContext, escort: tuple):
     user_id = message.from_user.id
     try:
-        escort = await get_escort(user_id)
-        if not escort:
-            await message.answer("⚠️ Ваш профиль не найден.", reply_markup=get_menu_keyboard(user_id))
-            return
         escort_id = escort[0]
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with db.read() as conn:
             cursor = await conn.execute(
                 '''
                 SELECT o.fanpay_order_id, o.id, o.squad_id, o.amount
-                FROM orders o
-                JOIN order_escorts oe ON o.id = oe.order_id
-                JOIN escorts e ON oe.escort_id = e.id
-                WHERE e.telegram_id = ? AND o.status = 'in_progress'
-                ''', (user_id,)
+                FROM order_escorts oe
+                JOIN orders o ON o.id = oe.order_id
+                WHERE oe.escort_id = ? AND o.status = 'in_progress'
+                ''', (escort_id,)
             )
             orders = await cursor.fetchall()
 
@@ -898,176 +2695,311 @@ async def complete_order(message: types.Message, state: FSMContext):
         await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
 
 @dp.message(Form.complete_order)
-async def process_complete_order(message: types.Message, state: FSMContext):
+async def process_complete_order(message: types.Message, state: FSMContext, escort: tuple):
     user_id = message.from_user.id
-    order_id = message.text.strip()
-    try:
-        escort = await get_escort(user_id)
-        if not escort:
-            await message.answer("⚠️ Ваш профиль не найден.", reply_markup=get_menu_keyboard(user_id))
-            await state.clear()
-            return
-        escort_id = escort[0]
-        username = escort[6] or "Unknown"
-        pubg_id = escort[2] or "Не указан"
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT id, squad_id, amount FROM orders WHERE fanpay_order_id = ? AND status = 'in_progress'",
-                (order_id,)
-            )
-            order = await cursor.fetchone()
-            if not order:
-                await message.answer(MESSAGES["order_already_completed"], reply_markup=get_menu_keyboard(user_id))
-                await state.clear()
-                return
-            order_db_id, squad_id, amount = order
-
-            # Проверка, начислен ли баланс (простая проверка для админов)
-            cursor = await conn.execute("SELECT SUM(balance) FROM escorts WHERE squad_id = ?", (squad_id,))
-            total_balance = (await cursor.fetchone())[0] or 0
-            if total_balance < amount:
-                await message.answer(f"⚠️ Общий баланс сквада ({total_balance:.2f} руб.) меньше суммы заказа ({amount:.2f} руб.). Обратитесь к администратору.", reply_markup=get_menu_keyboard(user_id))
-                await state.clear()
-                return
-
-            await conn.execute(
-                "UPDATE orders SET status = 'completed', completed_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (order_db_id,)
-            )
-            await conn.commit()
-
-        await message.answer(MESSAGES["order_completed"].format(order_id=order_id, username=username, telegram_id=user_id, pubg_id=pubg_id), reply_markup=get_menu_keyboard(user_id))
-        admin_message = MESSAGES["order_completed"].format(order_id=order_id, username=username, telegram_id=user_id, pubg_id=pubg_id)
-        await notify_admins(admin_message)
-
-        # Уведомление всех участников о завершении заказа
-        participants = await get_order_escorts(order_db_id)
-        for telegram_id, _, _, _, _ in participants:
-            try:
-                await bot.send_message(telegram_id, f"✅ Заказ #{order_id} завершен! Ожидайте оценки.")
-            except Exception as e:
-                logger.warning(f"Не удалось уведомить {telegram_id} о завершении заказа: {e}")
-
-        # Уведомление админов с запросом оценки
-        rating_keyboard = get_rating_keyboard(order_id)
-        await notify_admins(MESSAGES["rate_order"].format(order_id=order_id), reply_markup=rating_keyboard)
-
-        logger.info(f"Заказ #{order_id} завершен пользователем {user_id}")
+    order_id = message.text.strip()
+    try:
+        order_info = await get_order_info(order_id)
+        if not order_info:
+            await message.answer(MESSAGES["order_already_completed"].format(order_id=order_id), reply_markup=get_menu_keyboard(user_id))
+            await state.clear()
+            return
+        async with order_locks.hold(order_info[0]):
+            result, response = await claim_complete(order_info[0], escort, user_id, "balance")
+        await message.answer(response, reply_markup=get_menu_keyboard(user_id))
         await state.clear()
+        if result == "completed":
+            logger.info(f"Заказ #{order_id} завершен пользователем {user_id}")
     except Exception as e:
         logger.error(f"Ошибка в process_complete_order для {user_id}: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
         await state.clear()
 
-@dp.callback_query(F.data.startswith("rate_"))
-async def rate_order(callback: types.CallbackQuery, state: FSMContext):
+@dp.callback_query.action("rate", flags={"admin_only": True, "ack": "⏳ Сохраняем оценку…"})
+async def rate_order(callback: types.CallbackQuery, order_db_id: int, rating: int):
     user_id = callback.from_user.id
-    if not is_admin(user_id):
-        await callback.message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        await callback.answer()
-        return
     try:
-        _, order_id, rating = callback.data.split("_")
-        order_id = order_id
-        rating = int(rating)
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT id, squad_id FROM orders WHERE fanpay_order_id = ? AND status = 'completed'",
-                (order_id,)
-            )
-            order = await cursor.fetchone()
-            if not order:
-                await callback.message.answer("⚠️ Заказ не найден или не завершен.", reply_markup=get_menu_keyboard(user_id))
-                await callback.answer()
-                return
-            order_db_id, squad_id = order
-
-            cursor = await conn.execute(
-                "SELECT escort_id FROM order_escorts WHERE order_id = ?", (order_db_id,)
-            )
-            escorts = await cursor.fetchall()
-
-            for (escort_id,) in escorts:
-                await update_escort_reputation(escort_id, rating)
-            await update_squad_reputation(squad_id, rating)
-            await conn.execute(
-                "UPDATE orders SET rating = ? WHERE id = ?", (rating, order_db_id)
-            )
-            await conn.commit()
+        # Оценка применяется одной транзакцией: заказ, все его участники и сквад.
+        # Условие rating = 0 не даёт применить оценку повторно при двойном нажатии.
+        async with order_locks.hold(order_db_id):
+            async with db.write() as conn:
+                order = await conn.execute_fetchall(
+                    "UPDATE orders SET rating = ? WHERE id = ? AND status = 'completed' AND rating = 0 "
+                    "RETURNING fanpay_order_id, squad_id",
+                    (rating, order_db_id)
+                )
+                if order:
+                    order_id, squad_id = order[0]
+                    escorts = await conn.execute_fetchall(
+                        '''
+                        UPDATE escorts SET reputation = reputation + ?, rating = rating + ?, rating_count = rating_count + 1
+                        WHERE id IN (SELECT escort_id FROM order_escorts WHERE order_id = ?)
+                        RETURNING id
+                        ''', (rating, rating, order_db_id)
+                    )
+                    await conn.execute(
+                        "UPDATE squads SET rating = rating + ?, rating_count = rating_count + 1 WHERE id = ?",
+                        (rating, squad_id)
+                    )
+        if not order:
+            await callback.message.answer("⚠️ Заказ не найден, не завершен или уже оценен.", reply_markup=get_menu_keyboard(user_id))
+            return
+        escort_cache.invalidate_ids([escort_id for (escort_id,) in escorts])
+        stats_cache.invalidate()
 
         await callback.message.edit_text(MESSAGES["rating_submitted"].format(rating=rating, order_id=order_id), reply_markup=None)
         await notify_squad(squad_id, f"🌟 Заказ #{order_id} получил оценку {rating}!")
-        await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в rate_order для {user_id}: {e}")
         await callback.message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
-        await callback.answer()
 
 # --- Остальные обработчики ---
-@dp.message(F.text == "🔐 Админ-панель")
+@dp.message.text("🔐 Админ-панель", flags={"admin_only": True})
 async def admin_panel(message: types.Message):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     await message.answer("🔐 Админ-панель:", reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "🏆 Рейтинг сквадов")
-async def squad_rating(message: types.Message):
-    if not await check_access(message):
-        return
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT name, rating, rating_count FROM squads ORDER BY rating DESC"
-            )
-            squads = await cursor.fetchall()
+# --- Рейтинги с постраничным выводом ---
+LEADERBOARDS = {
+    "s": {
+        "table": "squads",
+        "name": "name",
+        "title": "🏆 Рейтинг сквадов:",
+        "empty": MESSAGES["no_squads"],
+        "row": "{position}. 🏠 {name}: {avg_rating:.2f} ⭐ ({rating_count} оценок)",
+    },
+    "u": {
+        "table": "escorts",
+        "name": "username",
+        "title": "🌟 Рейтинг пользователей:",
+        "empty": MESSAGES["no_escorts"],
+        "row": "{position}. 👤 @{name}: {avg_rating:.2f} ⭐ ({rating_count} оценок)",
+    },
+}
 
-        if not squads:
-            await message.answer(MESSAGES["no_squads"], reply_markup=get_menu_keyboard(message.from_user.id))
+async def fetch_leaderboard_page(kind: str, after=None, before=None):
+    # Keyset-пагинация по индексу (средняя оценка DESC, id DESC): одна страница — один запрос.
+    # Отдельное условие по средней оценке нужно, чтобы SQLite искал по индексу, а не сканировал его.
+    # Возвращает строки страницы и признак того, что в направлении чтения есть ещё записи.
+    board = LEADERBOARDS[kind]
+    columns = f"id, {board['name']}, avg_rating, rating_count"
+    if before is not None:
+        rows = await db.fetchall(
+            f"SELECT {columns} FROM {board['table']} "
+            "WHERE avg_rating >= ? AND (avg_rating, id) > (?, ?) "
+            "ORDER BY avg_rating ASC, id ASC LIMIT ?",
+            (before[0], *before, LEADERBOARD_PAGE_SIZE + 1)
+        )
+        has_more = len(rows) > LEADERBOARD_PAGE_SIZE
+        return list(reversed(rows[:LEADERBOARD_PAGE_SIZE])), has_more
+    if after is not None:
+        rows = await db.fetchall(
+            f"SELECT {columns} FROM {board['table']} "
+            "WHERE avg_rating <= ? AND (avg_rating, id) < (?, ?) "
+            "ORDER BY avg_rating DESC, id DESC LIMIT ?",
+            (after[0], *after, LEADERBOARD_PAGE_SIZE + 1)
+        )
+    else:
+        rows = await db.fetchall(
+            f"SELECT {columns} FROM {board['table']} ORDER BY avg_rating DESC, id DESC LIMIT ?",
+            (LEADERBOARD_PAGE_SIZE + 1,)
+        )
+    has_more = len(rows) > LEADERBOARD_PAGE_SIZE
+    return rows[:LEADERBOARD_PAGE_SIZE], has_more
+
+def render_leaderboard(kind: str, rows, offset: int, has_prev: bool, has_next: bool):
+    board = LEADERBOARDS[kind]
+    lines = [board["title"]]
+    for position, (_, name, avg_rating, rating_count) in enumerate(rows, start=offset + 1):
+        lines.append(board["row"].format(position=position, name=name or "Unknown", avg_rating=avg_rating, rating_count=rating_count))
+    buttons = []
+    if has_prev:
+        first_id, _, first_avg, _ = rows[0]
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Назад", callback_data=f"lb:{kind}:p:{max(offset - LEADERBOARD_PAGE_SIZE, 0)}:{first_avg!r}:{first_id}"
+        ))
+    if has_next:
+        last_id, _, last_avg, _ = rows[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Вперёд ➡️", callback_data=f"lb:{kind}:n:{offset + len(rows)}:{last_avg!r}:{last_id}"
+        ))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), keyboard
+
+async def send_leaderboard(message: types.Message, kind: str):
+    try:
+        rows, has_next = await fetch_leaderboard_page(kind)
+        if not rows:
+            await message.answer(LEADERBOARDS[kind]["empty"], reply_markup=get_menu_keyboard(message.from_user.id))
             return
-
-        response = "🏆 Рейтинг сквадов:\n"
-        for name, rating, rating_count in squads:
-            avg_rating = rating / rating_count if rating_count > 0 else 0
-            response += f"🏠 {name}: {avg_rating:.2f} ⭐ ({rating_count} оценок)\n"
-        await message.answer(response, reply_markup=get_menu_keyboard(message.from_user.id))
+        response, keyboard = render_leaderboard(kind, rows, 0, has_prev=False, has_next=has_next)
+        await message.answer(response, reply_markup=keyboard or get_menu_keyboard(message.from_user.id))
     except Exception as e:
-        logger.error(f"Ошибка в squad_rating: {e}")
+        logger.error(f"Ошибка в рейтинге {kind}: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(message.from_user.id))
 
-@dp.message(F.text == "🌟 Рейтинг пользователей")
+@dp.message.text("🏆 Рейтинг сквадов")
+async def squad_rating(message: types.Message):
+    await send_leaderboard(message, "s")
+
+@dp.message.text("🌟 Рейтинг пользователей")
 async def user_rating(message: types.Message):
-    if not await check_access(message):
-        return
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT username, rating, rating_count FROM escorts ORDER BY rating DESC"
-            )
-            escorts = await cursor.fetchall()
+    await send_leaderboard(message, "u")
 
-        if not escorts:
-            await message.answer(MESSAGES["no_escorts"], reply_markup=get_menu_keyboard(message.from_user.id))
+@dp.callback_query(F.data.startswith("lb:"))
+async def leaderboard_page(callback: types.CallbackQuery):
+    try:
+        _, kind, direction, offset, avg_rating, row_id = callback.data.split(":")
+        cursor = (float(avg_rating), int(row_id))
+        offset = int(offset)
+        if direction == "n":
+            rows, has_next = await fetch_leaderboard_page(kind, after=cursor)
+            has_prev = True
+        else:
+            rows, has_prev = await fetch_leaderboard_page(kind, before=cursor)
+            has_next = True
+            offset = offset if has_prev else 0
+        if not rows:
+            await callback.answer("Страница пуста")
             return
+        response, keyboard = render_leaderboard(kind, rows, offset, has_prev=has_prev, has_next=has_next)
+        await callback.message.edit_text(response, reply_markup=keyboard)
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка в leaderboard_page для {callback.from_user.id}: {e}")
+        await callback.answer(MESSAGES["error"])
+
+# --- Постраничные списки для админов ---
+MAX_MESSAGE_LENGTH = 4096
+
+def format_user_row(telegram_id, username, pubg_id, squad_name, is_banned, banned_until, restricted_until) -> str:
+    now = time.time()
+    status = "✅ Активен"
+    if is_banned:
+        status = "🚫 Заблокирован навсегда"
+    elif banned_until and banned_until > now:
+        status = f"🚫 Заблокирован до {format_epoch(banned_until)}"
+    elif restricted_until and restricted_until > now:
+        status = f"⛔ Ограничен до {format_epoch(restricted_until)}"
+    return (
+        f"ID: {telegram_id}, @{username or 'Unknown'}, PUBG ID: {pubg_id or 'Не указан'}, "
+        f"Сквад: {squad_name or 'Не назначен'}, Статус: {status}"
+    )
+
+def format_id_row(telegram_id, username) -> str:
+    return f"{telegram_id} - @{username or 'Unknown'}"
+
+ADMIN_LISTS = {
+    "ie": {
+        "title": "👤 Список сопровождающих (ID - username):",
+        "columns": "e.telegram_id, e.username",
+        "join": "",
+        "row": format_id_row,
+    },
+    "iu": {
+        "title": "👤 Список пользователей (ID - username):",
+        "columns": "e.telegram_id, e.username",
+        "join": "",
+        "row": format_id_row,
+    },
+    "b": {
+        "title": "💰 Балансы сопровождающих:",
+        "columns": "e.telegram_id, e.username, e.balance, s.name",
+        "join": "LEFT JOIN squads s ON e.squad_id = s.id",
+        "row": lambda telegram_id, username, balance, squad_name: (
+            f"ID: {telegram_id}, @{username or 'Unknown'}, Сквад: {squad_name or 'не назначен'}, Баланс: {balance:.2f} руб."
+        ),
+    },
+    "u": {
+        "title": "👥 Список всех пользователей:",
+        "columns": "e.telegram_id, e.username, e.pubg_id, s.name, e.is_banned, e.banned_until, e.restricted_until",
+        "join": "LEFT JOIN squads s ON e.squad_id = s.id",
+        "row": format_user_row,
+    },
+    "ab": {
+        "title": "📊 Балансы всех пользователей:",
+        "columns": "e.telegram_id, e.username, e.balance",
+        "join": "",
+        "row": lambda telegram_id, username, balance: f"ID: {telegram_id}, @{username or 'Unknown'}, Баланс: {balance:.2f} руб.",
+    },
+}
+
+async def fetch_admin_page(kind: str, after: int = 0, before: int = None):
+    # Keyset-пагинация по escorts.id. Строки читаются курсором по мере отрисовки, страница
+    # ограничена и ADMIN_PAGE_SIZE, и длиной сообщения, так что память не зависит от числа пользователей.
+    # Возвращает строки страницы, id их записей и признак того, что в направлении чтения есть ещё записи.
+    spec = ADMIN_LISTS[kind]
+    if before is not None:
+        condition, order, bound = "e.id < ?", "DESC", before
+    else:
+        condition, order, bound = "e.id > ?", "ASC", after
+    sql = (
+        f"SELECT e.id, {spec['columns']} FROM escorts e {spec['join']} "
+        f"WHERE {condition} ORDER BY e.id {order} LIMIT ?"
+    )
+    # Запас под заголовок с номером страницы
+    budget = MAX_MESSAGE_LENGTH - len(spec["title"]) - 32
+    lines, ids = [], []
+    has_more = False
+    async with db.read() as conn:
+        async with conn.execute(sql, (bound, ADMIN_PAGE_SIZE + 1)) as cursor:
+            async for row_id, *row in cursor:
+                line = spec["row"](*row)
+                if len(lines) == ADMIN_PAGE_SIZE or len(line) + 1 > budget:
+                    has_more = True
+                    break
+                budget -= len(line) + 1
+                lines.append(line)
+                ids.append(row_id)
+    if before is not None:
+        lines.reverse()
+        ids.reverse()
+    return lines, ids, has_more
+
+def render_admin_page(kind: str, lines, ids, page: int, has_prev: bool, has_next: bool):
+    title = ADMIN_LISTS[kind]["title"]
+    if has_prev or has_next:
+        title = f"{title} (стр. {page})"
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"al:{kind}:p:{page - 1}:{ids[0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"al:{kind}:n:{page + 1}:{ids[-1]}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join([title, *lines]), keyboard
+
+async def send_admin_list(message: types.Message, kind: str, reply_markup=None) -> bool:
+    # Первая страница списка; False, если список пуст. Без навигации сообщение получает reply_markup.
+    lines, ids, has_next = await fetch_admin_page(kind)
+    if not lines:
+        return False
+    response, keyboard = render_admin_page(kind, lines, ids, 1, has_prev=False, has_next=has_next)
+    await message.answer(response, reply_markup=keyboard or reply_markup)
+    return True
 
-        response = "🌟 Рейтинг пользователей:\n"
-        for username, rating, rating_count in escorts:
-            avg_rating = rating / rating_count if rating_count > 0 else 0
-            response += f"👤 @{username or 'Unknown'}: {avg_rating:.2f} ⭐ ({rating_count} оценок)\n"
-        await message.answer(response, reply_markup=get_menu_keyboard(message.from_user.id))
+@dp.callback_query(F.data.startswith("al:"), flags={"admin_only": True})
+async def admin_list_page(callback: types.CallbackQuery):
+    try:
+        _, kind, direction, page, row_id = callback.data.split(":")
+        page, row_id = int(page), int(row_id)
+        if direction == "n":
+            lines, ids, has_next = await fetch_admin_page(kind, after=row_id)
+            has_prev = True
+        else:
+            lines, ids, has_prev = await fetch_admin_page(kind, before=row_id)
+            has_next = True
+            page = page if has_prev else 1
+        if not lines:
+            await callback.answer("Страница пуста")
+            return
+        response, keyboard = render_admin_page(kind, lines, ids, page, has_prev=has_prev, has_next=has_next)
+        await callback.message.edit_text(response, reply_markup=keyboard)
+        await callback.answer()
     except Exception as e:
-        logger.error(f"Ошибка в user_rating: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(message.from_user.id))
+        logger.error(f"Ошибка в admin_list_page для {callback.from_user.id}: {e}")
+        await callback.answer(MESSAGES["error"])
 
-@dp.message(F.text == "🏠 Добавить сквад")
+@dp.message.text("🏠 Добавить сквад", flags={"admin_only": True})
 async def add_squad(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     await message.answer("🏠 Введите название нового сквада:", reply_markup=ReplyKeyboardRemove())
     await state.set_state(Form.squad_name)
 
@@ -1080,12 +3012,11 @@ async def process_squad_name(message: types.Message, state: FSMContext):
         await state.clear()
         return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute("INSERT INTO squads (name) VALUES (?)", (squad_name,))
-            await conn.commit()
+        await db.execute("INSERT INTO squads (name) VALUES (?)", (squad_name,))
+        stats_cache.invalidate()
         await message.answer(f"🏠 Сквад '{squad_name}' успешно добавлен!", reply_markup=get_admin_keyboard())
         logger.info(f"Добавлен сквад: {squad_name}")
-        await notify_admins(f"🏠 Новый сквад '{squad_name}' создан")
+        notify_admins(f"🏠 Новый сквад '{squad_name}' создан")
     except aiosqlite.IntegrityError:
         await message.answer(f"⚠️ Сквад '{squad_name}' уже существует!", reply_markup=get_admin_keyboard())
     except Exception as e:
@@ -1094,15 +3025,10 @@ async def process_squad_name(message: types.Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.message(F.text == "📋 Список сквадов")
+@dp.message.text("📋 Список сквадов", flags={"admin_only": True})
 async def list_squads(message: types.Message):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with db.read() as conn:
             cursor = await conn.execute(
                 "SELECT id, name, (SELECT COUNT(*) FROM escorts WHERE squad_id = squads.id) as count "
                 "FROM squads"
@@ -1121,19 +3047,31 @@ async def list_squads(message: types.Message):
         logger.error(f"Ошибка в list_squads: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "👤 Добавить сопровождающего")
+@dp.message.text("👤 Добавить сопровождающего", flags={"admin_only": True})
 async def add_escort_handler(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     await message.answer(
         "👤 Введите Telegram ID и название сквада через пробел:\nПример: 123456789 НазваниеСквада",
         reply_markup=ReplyKeyboardRemove()
     )
     await state.set_state(Form.escort_info)
 
+async def assign_escort_squad(telegram_id: int, squad_name: str) -> str:
+    # Возвращает "assigned", "no_squad" или "full"; ответ админу отправляется после транзакции
+    async with db.write() as conn:
+        squad = await conn.execute_fetchall("SELECT id FROM squads WHERE name = ?", (squad_name,))
+        if not squad:
+            return "no_squad"
+        squad_id = squad[0][0]
+        rows = await conn.execute_fetchall("SELECT COUNT(*) FROM escorts WHERE squad_id = ?", (squad_id,))
+        if rows[0][0] >= MAX_SQUAD_MEMBERS:
+            return "full"
+        await conn.execute(
+            "INSERT OR REPLACE INTO escorts (telegram_id, squad_id, username, rules_accepted) "
+            "VALUES (?, ?, (SELECT username FROM escorts WHERE telegram_id = ?), 0)",
+            (telegram_id, squad_id, telegram_id)
+        )
+    return "assigned"
+
 @dp.message(Form.escort_info)
 async def process_escort_info(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
@@ -1146,31 +3084,19 @@ async def process_escort_info(message: types.Message, state: FSMContext):
         escort_id = int(parts[0])
         squad_name = parts[1].strip()
 
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT id FROM squads WHERE name = ?", (squad_name,))
-            squad = await cursor.fetchone()
-            if not squad:
-                await message.answer(f"⚠️ Сквад '{squad_name}' не найден!", reply_markup=get_admin_keyboard())
-                await state.clear()
-                return
-
-            cursor = await conn.execute("SELECT COUNT(*) FROM escorts WHERE squad_id = ?", (squad[0],))
-            member_count = (await cursor.fetchone())[0]
-            if member_count >= 6:
-                await message.answer(MESSAGES["squad_full"].format(squad_name=squad_name), reply_markup=get_admin_keyboard())
-                await state.clear()
-                return
-
-            await conn.execute(
-                "INSERT OR REPLACE INTO escorts (telegram_id, squad_id, username, rules_accepted) "
-                "VALUES (?, ?, (SELECT username FROM escorts WHERE telegram_id = ?), 0)",
-                (escort_id, squad[0], escort_id)
-            )
-            await conn.commit()
+        result = await assign_escort_squad(escort_id, squad_name)
+        if result == "no_squad":
+            await message.answer(f"⚠️ Сквад '{squad_name}' не найден!", reply_markup=get_admin_keyboard())
+            return
+        if result == "full":
+            await message.answer(MESSAGES["squad_full"].format(squad_name=squad_name), reply_markup=get_admin_keyboard())
+            return
+        escort_cache.invalidate(escort_id)
+        stats_cache.invalidate()
 
         await message.answer(f"👤 Пользователь {escort_id} добавлен в сквад '{squad_name}'!", reply_markup=get_admin_keyboard())
         logger.info(f"Добавлен сопровождающий {escort_id} в сквад {squad_name}")
-        await notify_admins(f"👤 Пользователь {escort_id} добавлен в сквад '{squad_name}'")
+        notify_admins(f"👤 Пользователь {escort_id} добавлен в сквад '{squad_name}'")
     except ValueError:
         await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
     except Exception as e:
@@ -1179,79 +3105,59 @@ async def process_escort_info(message: types.Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.message(F.text == "🗑️ Удалить сопровождающего")
+@dp.message.text("🗑️ Удалить сопровождающего", flags={"admin_only": True})
 async def remove_escort(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT telegram_id, username FROM escorts")
-            escorts = await cursor.fetchall()
-
-        if not escorts:
+        if not await send_admin_list(message, "ie"):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
             return
-
-        response = "👤 Список сопровождающих (ID - username):\n"
-        for telegram_id, username in escorts:
-            response += f"{telegram_id} - @{username or 'Unknown'}\n"
-        response += "\nВведите ID сопровождающего для удаления:"
-        await message.answer(response, reply_markup=ReplyKeyboardRemove())
-        await state.set_state(Form.escort_info)
+        await message.answer("Введите ID сопровождающего для удаления:", reply_markup=ReplyKeyboardRemove())
+        await state.set_state(Form.remove_escort)
     except Exception as e:
         logger.error(f"Ошибка в remove_escort: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "💰 Балансы сопровождающих")
-async def escort_balances(message: types.Message):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
+@dp.message(Form.remove_escort)
+async def process_remove_escort(message: types.Message, state: FSMContext):
+    # Сопровождающий выводится из сквада; баланс и история заказов остаются
+    user_id = message.from_user.id
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT e.telegram_id, e.username, e.balance, s.name FROM escorts e LEFT JOIN squads s ON e.squad_id = s.id"
-            )
-            escorts = await cursor.fetchall()
+        target_id = int(message.text.strip())
+        cursor = await db.execute(
+            "UPDATE escorts SET squad_id = NULL WHERE telegram_id = ? AND squad_id IS NOT NULL", (target_id,)
+        )
+        escort_cache.invalidate(target_id)
+        stats_cache.invalidate()
+        if cursor.rowcount > 0:
+            await message.answer(f"🗑️ Пользователь {target_id} удалён из сквада", reply_markup=get_admin_keyboard())
+            logger.info(f"Пользователь {target_id} удалён из сквада администратором {user_id}")
+            notify_admins(f"🗑️ Пользователь {target_id} удалён из сквада")
+        else:
+            await message.answer(f"⚠️ Сопровождающий {target_id} не найден или не состоит в скваде.", reply_markup=get_admin_keyboard())
+    except ValueError:
+        await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
+    except Exception as e:
+        logger.error(f"Ошибка в process_remove_escort для {user_id}: {e}")
+        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
+    finally:
+        await state.clear()
 
-        if not escorts:
+@dp.message.text("💰 Балансы сопровождающих", flags={"admin_only": True})
+async def escort_balances(message: types.Message):
+    try:
+        if not await send_admin_list(message, "b", reply_markup=get_admin_keyboard()):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
-            return
-
-        response = "💰 Балансы сопровождающих:\n"
-        for telegram_id, username, balance, squad_name in escorts:
-            response += f"ID: {telegram_id}, @{username or 'Unknown'}, Сквад: {squad_name or 'не назначен'}, Баланс: {balance:.2f} руб.\n"
-        await message.answer(response, reply_markup=get_admin_keyboard())
     except Exception as e:
         logger.error(f"Ошибка в escort_balances: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "💸 Начислить")
+@dp.message.text("💸 Начислить", flags={"admin_only": True})
 async def add_balance(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT telegram_id, username FROM escorts")
-            escorts = await cursor.fetchall()
-
-        if not escorts:
+        if not await send_admin_list(message, "ie"):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
             return
-
-        response = "👤 Список сопровождающих (ID - username):\n"
-        for telegram_id, username in escorts:
-            response += f"{telegram_id} - @{username or 'Unknown'}\n"
-        response += "\nВведите ID сопровождающего и сумму через пробел:\nПример: 123456789 500"
-        await message.answer(response, reply_markup=ReplyKeyboardRemove())
+        await message.answer("Введите ID сопровождающего и сумму через пробел:\nПример: 123456789 500", reply_markup=ReplyKeyboardRemove())
         await state.set_state(Form.balance_amount)
     except Exception as e:
         logger.error(f"Ошибка в add_balance: {e}")
@@ -1273,21 +3179,21 @@ async def process_balance_amount(message: types.Message, state: FSMContext):
             await state.clear()
             return
 
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "UPDATE escorts SET balance = balance + ? WHERE telegram_id = ?",
-                (amount, target_id)
-            )
-            await conn.commit()
-            if cursor.rowcount > 0:
-                await message.answer(MESSAGES["balance_added"].format(user_id=target_id, amount=amount), reply_markup=get_admin_keyboard())
-                logger.info(f"Начислено {amount} руб. пользователю {target_id} администратором {user_id}")
-                try:
-                    await bot.send_message(target_id, f"💸 Вам начислено {amount} руб. на баланс!")
-                except Exception as e:
-                    logger.warning(f"Не удалось уведомить {target_id}: {e}")
-            else:
-                await message.answer(f"⚠️ Пользователь {target_id} не найден.", reply_markup=get_admin_keyboard())
+        cursor = await db.execute(
+            "UPDATE escorts SET balance = balance + ? WHERE telegram_id = ?",
+            (amount, target_id)
+        )
+        escort_cache.invalidate(target_id)
+        stats_cache.invalidate()
+        if cursor.rowcount > 0:
+            await message.answer(MESSAGES["balance_added"].format(user_id=target_id, amount=amount), reply_markup=get_admin_keyboard())
+            logger.info(f"Начислено {amount} руб. пользователю {target_id} администратором {user_id}")
+            try:
+                await bot.send_message(target_id, f"💸 Вам начислено {amount} руб. на баланс!")
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить {target_id}: {e}")
+        else:
+            await message.answer(f"⚠️ Пользователь {target_id} не найден.", reply_markup=get_admin_keyboard())
     except ValueError:
         await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
     except Exception as e:
@@ -1296,40 +3202,22 @@ async def process_balance_amount(message: types.Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.message(F.text == "📊 Статистика")
+@dp.message.text("📊 Статистика", flags={"admin_only": True})
 async def squad_statistics(message: types.Message):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                '''
-                SELECT s.name, COUNT(e.id) as member_count,
-                       SUM(e.completed_orders) as total_orders,
-                       SUM(e.balance) as total_balance,
-                       s.rating, s.rating_count
-                FROM squads s
-                LEFT JOIN escorts e ON e.squad_id = s.id
-                GROUP BY s.id
-                '''
-            )
-            squads = await cursor.fetchall()
+        squads = (await stats_cache.get())["squads"]
 
         if not squads:
             await message.answer(MESSAGES["no_squads"], reply_markup=get_admin_keyboard())
             return
 
         response = "📊 Статистика сквадов:\n"
-        for name, member_count, total_orders, total_balance, rating, rating_count in squads:
-            avg_rating = rating / rating_count if rating_count > 0 else 0
+        for name, member_count, total_orders, total_balance, avg_rating, rating_count in squads:
             response += (
                 f"🏠 {name}\n"
                 f"👥 Участников: {member_count}\n"
-                f"📋 Заказов: {total_orders or 0}\n"
-                f"💰 Заработок: {total_balance or 0:.2f} руб.\n"
+                f"📋 Заказов: {total_orders}\n"
+                f"💰 Заработок: {total_balance:.2f} руб.\n"
                 f"🌟 Рейтинг: {avg_rating:.2f} ⭐ ({rating_count} оценок)\n\n"
             )
         await message.answer(response, reply_markup=get_admin_keyboard())
@@ -1337,13 +3225,8 @@ async def squad_statistics(message: types.Message):
         logger.error(f"Ошибка в squad_statistics: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "📝 Добавить заказ")
+@dp.message.text("📝 Добавить заказ", flags={"admin_only": True})
 async def add_order(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     await message.answer(
         "📝 Введите ID заказа, сумму, описание и имя клиента через пробел:\n"
         "Пример: 789 2000 Продажа_предмета Client1",
@@ -1366,19 +3249,17 @@ async def process_add_order(message: types.Message, state: FSMContext):
             await state.clear()
             return
 
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute(
-                "INSERT INTO orders (fanpay_order_id, customer_info, amount, status) VALUES (?, ?, ?, 'pending')",
-                (order_id, customer, amount)
-            )
-            await conn.commit()
+        await db.execute(
+            "INSERT INTO orders (fanpay_order_id, customer_info, amount, status) VALUES (?, ?, ?, 'pending')",
+            (order_id, customer, amount)
+        )
 
         await message.answer(
             MESSAGES["order_added"].format(order_id=order_id, amount=amount, description=description, customer=customer),
             reply_markup=get_admin_keyboard()
         )
         logger.info(f"Добавлен заказ #{order_id} администратором {user_id}")
-        await notify_admins(f"📝 Новый заказ #{order_id} добавлен: {amount} руб., {description}, клиент: {customer}")
+        notify_admins(f"📝 Новый заказ #{order_id} добавлен: {amount} руб., {description}, клиент: {customer}")
     except ValueError:
         await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
     except Exception as e:
@@ -1387,217 +3268,160 @@ async def process_add_order(message: types.Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.message(F.text == "🚫 Бан навсегда")
+@dp.message.text("🚫 Бан навсегда", flags={"admin_only": True})
 async def ban_user_permanent(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT telegram_id, username FROM escorts")
-            escorts = await cursor.fetchall()
-
-        if not escorts:
+        if not await send_admin_list(message, "iu"):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
             return
-
-        response = "👤 Список пользователей (ID - username):\n"
-        for telegram_id, username in escorts:
-            response += f"{telegram_id} - @{username or 'Unknown'}\n"
-        response += "\nВведите ID пользователя для блокировки:"
-        await message.answer(response, reply_markup=ReplyKeyboardRemove())
-        await state.set_state(Form.escort_info)
+        await message.answer("Введите ID пользователя для блокировки:", reply_markup=ReplyKeyboardRemove())
+        await state.set_state(Form.ban_permanent)
     except Exception as e:
         logger.error(f"Ошибка в ban_user_permanent: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "⏰ Бан на время")
-async def ban_user_temporary(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
+@dp.message(Form.ban_permanent)
+async def process_ban_permanent(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT telegram_id, username FROM escorts")
-            escorts = await cursor.fetchall()
+        target_id = int(message.text.strip())
+        cursor = await db.execute("UPDATE escorts SET is_banned = 1 WHERE telegram_id = ?", (target_id,))
+        escort_cache.invalidate(target_id)
+        if cursor.rowcount > 0:
+            await message.answer(f"🚫 Пользователь {target_id} заблокирован навсегда", reply_markup=get_admin_keyboard())
+            logger.info(f"Пользователь {target_id} заблокирован навсегда администратором {user_id}")
+            try:
+                await bot.send_message(target_id, MESSAGES["user_banned"], reply_markup=ReplyKeyboardRemove())
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить {target_id}: {e}")
+        else:
+            await message.answer(f"⚠️ Пользователь {target_id} не найден.", reply_markup=get_admin_keyboard())
+    except ValueError:
+        await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
+    except Exception as e:
+        logger.error(f"Ошибка в process_ban_permanent для {user_id}: {e}")
+        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
+    finally:
+        await state.clear()
 
-        if not escorts:
+@dp.message.text("⏰ Бан на время", flags={"admin_only": True})
+async def ban_user_temporary(message: types.Message, state: FSMContext):
+    try:
+        if not await send_admin_list(message, "iu"):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
             return
-
-        response = "👤 Список пользователей (ID - username):\n"
-        for telegram_id, username in escorts:
-            response += f"{telegram_id} - @{username or 'Unknown'}\n"
-        response += "\nВведите ID пользователя и длительность в днях через пробел:\nПример: 123456789 7"
-        await message.answer(response, reply_markup=ReplyKeyboardRemove())
+        await message.answer("Введите ID пользователя и длительность в днях через пробел:\nПример: 123456789 7", reply_markup=ReplyKeyboardRemove())
         await state.set_state(Form.ban_duration)
     except Exception as e:
         logger.error(f"Ошибка в ban_user_temporary: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(Form.ban_duration)
-async def process_ban_duration(message: types.Message, state: FSMContext):
+async def apply_sanction(message: types.Message, state: FSMContext, kind: str):
+    # Бан или ограничение на N дней: "ID дни"
     user_id = message.from_user.id
+    sanction = SANCTIONS[kind]
     try:
         parts = message.text.split()
-        if len(parts) != 2:
+        if len(parts) != 2 or int(parts[1]) <= 0:
             await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
-            await state.clear()
             return
         target_id = int(parts[0])
-        days = int(parts[1])
-        ban_until = datetime.now() + timedelta(days=days)
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute(
-                "UPDATE escorts SET ban_until = ? WHERE telegram_id = ?",
-                (ban_until.isoformat(), target_id)
-            )
-            await conn.commit()
-            if conn.rowcount > 0:
-                await message.answer(f"🚫 Пользователь {target_id} заблокирован до {ban_until}", reply_markup=get_admin_keyboard())
-                logger.info(f"Пользователь {target_id} заблокирован до {ban_until}")
-                try:
-                    await bot.send_message(target_id, f"🚫 Вы заблокированы до {ban_until}")
-                except Exception as e:
-                    logger.warning(f"Не удалось уведомить {target_id}: {e}")
-            else:
-                await message.answer(f"⚠️ Пользователь {target_id} не найден.", reply_markup=get_admin_keyboard())
+        until = int(time.time()) + int(parts[1]) * 86400
+        cursor = await db.execute(
+            f"UPDATE escorts SET {sanction['column']} = ? WHERE telegram_id = ?", (until, target_id)
+        )
+        escort_cache.invalidate(target_id)
+        if cursor.rowcount > 0:
+            sanction_sweeper.schedule(target_id, kind, until)
+            date = format_epoch(until)
+            await message.answer(sanction["applied"].format(user_id=target_id, date=date), reply_markup=get_admin_keyboard())
+            logger.info(sanction["applied"].format(user_id=target_id, date=date))
+            try:
+                await bot.send_message(target_id, sanction["notice"].format(date=date))
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить {target_id}: {e}")
+        else:
+            await message.answer(f"⚠️ Пользователь {target_id} не найден.", reply_markup=get_admin_keyboard())
     except ValueError:
         await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
     except Exception as e:
-        logger.error(f"Ошибка в process_ban_duration для {user_id}: {e}")
+        logger.error(f"Ошибка в apply_sanction ({kind}) для {user_id}: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
     finally:
         await state.clear()
 
-@dp.message(F.text == "⛔ Ограничить")
+@dp.message(Form.ban_duration)
+async def process_ban_duration(message: types.Message, state: FSMContext):
+    await apply_sanction(message, state, "ban")
+
+@dp.message(Form.restrict_duration)
+async def process_restrict_duration(message: types.Message, state: FSMContext):
+    await apply_sanction(message, state, "restrict")
+
+@dp.message.text("⛔ Ограничить", flags={"admin_only": True})
 async def restrict_user(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT telegram_id, username FROM escorts")
-            escorts = await cursor.fetchall()
-
-        if not escorts:
+        if not await send_admin_list(message, "iu"):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
             return
-
-        response = "👤 Список пользователей (ID - username):\n"
-        for telegram_id, username in escorts:
-            response += f"{telegram_id} - @{username or 'Unknown'}\n"
-        response += "\nВведите ID пользователя и длительность в днях через пробел:\nПример: 123456789 7"
-        await message.answer(response, reply_markup=ReplyKeyboardRemove())
-        await state.set_state(Form.ban_duration)
+        await message.answer("Введите ID пользователя и длительность в днях через пробел:\nПример: 123456789 7", reply_markup=ReplyKeyboardRemove())
+        await state.set_state(Form.restrict_duration)
     except Exception as e:
         logger.error(f"Ошибка в restrict_user: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "👥 Пользователи")
+@dp.message.text("👥 Пользователи", flags={"admin_only": True})
 async def list_users(message: types.Message):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                '''
-                SELECT e.telegram_id, e.username, e.pubg_id, s.name, e.is_banned, e.ban_until, e.restrict_until
-                FROM escorts e
-                LEFT JOIN squads s ON e.squad_id = s.id
-                '''
-            )
-            escorts = await cursor.fetchall()
-
-        if not escorts:
+        if not await send_admin_list(message, "u", reply_markup=get_admin_keyboard()):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
-            return
-
-        response = "👥 Список всех пользователей:\n"
-        for telegram_id, username, pubg_id, squad_name, is_banned, ban_until, restrict_until in escorts:
-            status = "✅ Активен"
-            if is_banned:
-                status = "🚫 Заблокирован навсегда"
-            elif ban_until and datetime.fromisoformat(ban_until) > datetime.now():
-                status = f"🚫 Заблокирован до {ban_until}"
-            elif restrict_until and datetime.fromisoformat(restrict_until) > datetime.now():
-                status = f"⛔ Ограничен до {restrict_until}"
-            response += (
-                f"ID: {telegram_id}, @{username or 'Unknown'}, PUBG ID: {pubg_id or 'Не указан'}, "
-                f"Сквад: {squad_name or 'Не назначен'}, Статус: {status}\n"
-            )
-        await message.answer(response, reply_markup=get_admin_keyboard())
     except Exception as e:
         logger.error(f"Ошибка в list_users: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "💰 Обнулить баланс")
+@dp.message.text("💰 Обнулить баланс", flags={"admin_only": True})
 async def zero_balance(message: types.Message, state: FSMContext):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT telegram_id, username FROM escorts")
-            escorts = await cursor.fetchall()
-
-        if not escorts:
+        if not await send_admin_list(message, "iu"):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
             return
-
-        response = "👤 Список пользователей (ID - username):\n"
-        for telegram_id, username in escorts:
-            response += f"{telegram_id} - @{username or 'Unknown'}\n"
-        response += "\nВведите ID пользователя для обнуления баланса:"
-        await message.answer(response, reply_markup=ReplyKeyboardRemove())
-        await state.set_state(Form.escort_info)
+        await message.answer("Введите ID пользователя для обнуления баланса:", reply_markup=ReplyKeyboardRemove())
+        await state.set_state(Form.zero_balance)
     except Exception as e:
         logger.error(f"Ошибка в zero_balance: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "📊 Все балансы")
-async def view_all_balances(message: types.Message):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
+@dp.message(Form.zero_balance)
+async def process_zero_balance(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT telegram_id, username, balance FROM escorts"
-            )
-            escorts = await cursor.fetchall()
+        target_id = int(message.text.strip())
+        cursor = await db.execute("UPDATE escorts SET balance = 0 WHERE telegram_id = ?", (target_id,))
+        escort_cache.invalidate(target_id)
+        stats_cache.invalidate()
+        if cursor.rowcount > 0:
+            await message.answer(f"💰 Баланс пользователя {target_id} обнулён", reply_markup=get_admin_keyboard())
+            logger.info(f"Баланс пользователя {target_id} обнулён администратором {user_id}")
+        else:
+            await message.answer(f"⚠️ Пользователь {target_id} не найден.", reply_markup=get_admin_keyboard())
+    except ValueError:
+        await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
+    except Exception as e:
+        logger.error(f"Ошибка в process_zero_balance для {user_id}: {e}")
+        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
+    finally:
+        await state.clear()
 
-        if not escorts:
+@dp.message.text("📊 Все балансы", flags={"admin_only": True})
+async def view_all_balances(message: types.Message):
+    try:
+        if not await send_admin_list(message, "ab", reply_markup=get_admin_keyboard()):
             await message.answer(MESSAGES["no_escorts"], reply_markup=get_admin_keyboard())
-            return
-
-        response = "📊 Балансы всех пользователей:\n"
-        for telegram_id, username, balance in escorts:
-            response += f"ID: {telegram_id}, @{username or 'Unknown'}, Баланс: {balance:.2f} руб.\n"
-        await message.answer(response, reply_markup=get_admin_keyboard())
     except Exception as e:
         logger.error(f"Ошибка в view_all_balances: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
-@dp.message(F.text == "📖 Справочник админ-команд")
+@dp.message.text("📖 Справочник админ-команд", flags={"admin_only": True})
 async def admin_commands_help(message: types.Message):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
-        return
     try:
         response = (
             "📖 Справочник админ-команд:\n"
@@ -1621,66 +3445,382 @@ async def admin_commands_help(message: types.Message):
         logger.error(f"Ошибка в admin_commands_help: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
-@dp.message(F.text == "🔙 На главную")
+@dp.message.text("🔙 На главную")
 async def back_to_menu(message: types.Message):
-    if not await check_access(message):
-        return
     await message.answer("🔙 Вы вернулись в главное меню:", reply_markup=get_menu_keyboard(message.from_user.id))
 
-# --- Команда /stats для общей статистики ---
-@dp.message(Command("stats"))
-async def cmd_stats(message: types.Message):
-    if not await check_access(message):
-        return
-    if not is_admin(message.from_user.id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(message.from_user.id))
+# --- Массовый импорт сквадов, сопровождающих и заказов ---
+# Bot API отдаёт ботам файлы не больше 20 МБ
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+IMPORT_MAX_ERRORS_SHOWN = 20
+
+IMPORT_HELP = (
+    "📥 Отправьте файл CSV или JSON Lines (один объект на строку), кодировка UTF-8.\n"
+    "Тип записи задаёт поле type (squad, escort, order) или набор полей:\n"
+    "• сквад: name\n"
+    "• сопровождающий: telegram_id, squad, username (необязательно)\n"
+    "• заказ: fanpay_order_id, amount, customer\n"
+    "Пример CSV:\n"
+    "type,name,telegram_id,squad,fanpay_order_id,amount,customer\n"
+    "squad,Alpha,,,,,\n"
+    "escort,,123456789,Alpha,,,\n"
+    "order,,,,789,2000,Client1"
+)
+
+class ImportResult:
+    def __init__(self):
+        self.accepted = {"squad": 0, "escort": 0, "order": 0}
+        self.rejected = 0
+        self.errors = []  # (номер строки, причина), первые IMPORT_MAX_ERRORS_SHOWN
+        self.squad_names = set()  # уже импортированные из файла — для проверки дублей
+        self.order_ids = set()
+        self.telegram_ids = []
+
+    def reject(self, line: int, reason: str):
+        self.rejected += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS_SHOWN:
+            self.errors.append((line, reason))
+
+    def summary(self) -> str:
+        response = (
+            "📥 Импорт завершён:\n"
+            f"🏠 Сквадов: {self.accepted['squad']}\n"
+            f"👤 Сопровождающих: {self.accepted['escort']}\n"
+            f"📝 Заказов: {self.accepted['order']}\n"
+            f"❌ Отклонено строк: {self.rejected}"
+        )
+        if self.errors:
+            response += "\n\n" + "\n".join(f"Строка {line}: {reason}" for line, reason in sorted(self.errors))
+            if self.rejected > len(self.errors):
+                response += f"\n… и ещё {self.rejected - len(self.errors)}"
+        return response
+
+def import_record_type(record: dict):
+    kind = str(record.get("type") or "").strip().lower()
+    if kind:
+        return kind
+    if record.get("fanpay_order_id"):
+        return "order"
+    if record.get("telegram_id"):
+        return "escort"
+    if record.get("name"):
+        return "squad"
+    return None
+
+def iter_import_records(buffer, filename: str):
+    # Построчный разбор загруженного файла: (номер строки, тип, запись или None при ошибке разбора)
+    text = io.TextIOWrapper(buffer, encoding="utf-8-sig", newline="")
+    if filename.lower().endswith((".json", ".jsonl")):
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict):
+                yield line_number, None, None
+                continue
+            yield line_number, import_record_type(record), record
         return
+    header = text.readline()
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT COUNT(*) FROM escorts")
-            total_escorts = (await cursor.fetchone())[0]
-            cursor = await conn.execute("SELECT COUNT(*) FROM squads")
-            total_squads = (await cursor.fetchone())[0]
-            cursor = await conn.execute("SELECT COUNT(*) FROM orders WHERE status = 'completed'")
-            completed_orders = (await cursor.fetchone())[0]
-            cursor = await conn.execute("SELECT SUM(amount) FROM orders WHERE status = 'completed'")
-            total_earnings = (await cursor.fetchone())[0] or 0
-            cursor = await conn.execute("SELECT AVG(rating) FROM orders WHERE status = 'completed'")
-            avg_rating = (await cursor.fetchone())[0] or 0
+        dialect = csv.Sniffer().sniff(header, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(itertools.chain([header], text), dialect=dialect)
+    for record in reader:
+        if not any(value for value in record.values() if isinstance(value, str)):
+            continue
+        yield reader.line_num, import_record_type(record), record
+
+def import_field(record: dict, name: str) -> str:
+    return str(record.get(name) or "").strip()
+
+def sql_placeholders(values) -> str:
+    return ", ".join("?" * len(values))
+
+async def import_chunk(result: ImportResult, chunk):
+    # Одна транзакция на пачку: проверки выполняются по состоянию БД внутри неё, вставки — executemany.
+    # Сначала сквады, затем сопровождающие и заказы, чтобы строки могли ссылаться на сквады из той же пачки.
+    by_type = {"squad": [], "escort": [], "order": []}
+    for line, kind, record in chunk:
+        if record is None:
+            result.reject(line, "запись не разобрана")
+        elif kind not in by_type:
+            result.reject(line, f"неизвестный тип записи: {kind or 'не указан'}")
+        else:
+            by_type[kind].append((line, record))
+
+    async with db.write(immediate=True) as conn:
+        squads = [(line, import_field(record, "name")) for line, record in by_type["squad"]]
+        names = list({name for _, name in squads if name})
+        existing = set()
+        if names:
+            existing = {name for (name,) in await conn.execute_fetchall(
+                f"SELECT name FROM squads WHERE name IN ({sql_placeholders(names)})", names
+            )}
+        rows = []
+        for line, name in squads:
+            if not name:
+                result.reject(line, "не указано название сквада")
+            elif name in existing or name in result.squad_names:
+                result.reject(line, f"сквад '{name}' уже существует")
+            else:
+                result.squad_names.add(name)
+                rows.append((name,))
+        await conn.executemany("INSERT INTO squads (name) VALUES (?)", rows)
+        result.accepted["squad"] += len(rows)
+
+        escorts = []
+        for line, record in by_type["escort"]:
+            try:
+                telegram_id = int(import_field(record, "telegram_id"))
+            except ValueError:
+                result.reject(line, "неверный telegram_id")
+                continue
+            squad_name = import_field(record, "squad")
+            if not squad_name:
+                result.reject(line, "не указан сквад")
+                continue
+            escorts.append((line, telegram_id, squad_name, import_field(record, "username").lstrip("@") or None))
+        if escorts:
+            names = list({squad_name for _, _, squad_name, _ in escorts})
+            # Счётчики участников ведутся в памяти по ходу пачки
+            squad_members = {}
+            squad_ids = {}
+            for squad_id, name, member_count in await conn.execute_fetchall(
+                f"SELECT s.id, s.name, COUNT(e.id) FROM squads s LEFT JOIN escorts e ON e.squad_id = s.id "
+                f"WHERE s.name IN ({sql_placeholders(names)}) GROUP BY s.id", names
+            ):
+                squad_ids[name] = squad_id
+                squad_members[squad_id] = member_count
+            telegram_ids = list({telegram_id for _, telegram_id, _, _ in escorts})
+            current_squads = dict(await conn.execute_fetchall(
+                f"SELECT telegram_id, squad_id FROM escorts WHERE telegram_id IN ({sql_placeholders(telegram_ids)})",
+                telegram_ids
+            ))
+            rows = []
+            for line, telegram_id, squad_name, username in escorts:
+                squad_id = squad_ids.get(squad_name)
+                if squad_id is None:
+                    result.reject(line, f"сквад '{squad_name}' не найден")
+                elif current_squads.get(telegram_id) == squad_id:
+                    result.reject(line, f"пользователь {telegram_id} уже в скваде '{squad_name}'")
+                elif squad_members[squad_id] >= MAX_SQUAD_MEMBERS:
+                    result.reject(line, f"в скваде '{squad_name}' уже {MAX_SQUAD_MEMBERS} участников")
+                else:
+                    previous = current_squads.get(telegram_id)
+                    if previous in squad_members:
+                        squad_members[previous] -= 1
+                    squad_members[squad_id] += 1
+                    current_squads[telegram_id] = squad_id
+                    rows.append((telegram_id, squad_id, username))
+            # Существующий профиль переносится в сквад с сохранением баланса и статистики
+            await conn.executemany(
+                "INSERT INTO escorts (telegram_id, squad_id, username, rules_accepted) VALUES (?, ?, ?, 0) "
+                "ON CONFLICT(telegram_id) DO UPDATE SET squad_id = excluded.squad_id, "
+                "username = COALESCE(excluded.username, escorts.username)",
+                rows
+            )
+            result.accepted["escort"] += len(rows)
+            result.telegram_ids.extend(telegram_id for telegram_id, _, _ in rows)
+
+        orders = [(line, import_field(record, "fanpay_order_id"), record) for line, record in by_type["order"]]
+        order_ids = list({order_id for _, order_id, _ in orders if order_id})
+        existing = set()
+        if order_ids:
+            existing = {order_id for (order_id,) in await conn.execute_fetchall(
+                f"SELECT fanpay_order_id FROM orders WHERE fanpay_order_id IN ({sql_placeholders(order_ids)})", order_ids
+            )}
+        rows = []
+        for line, order_id, record in orders:
+            try:
+                amount = float(import_field(record, "amount").replace(",", "."))
+            except ValueError:
+                amount = None
+            if not order_id:
+                result.reject(line, "не указан fanpay_order_id")
+            elif order_id in existing or order_id in result.order_ids:
+                result.reject(line, f"заказ #{order_id} уже существует")
+            elif amount is None or not amount > 0:
+                result.reject(line, "сумма должна быть положительным числом")
+            else:
+                result.order_ids.add(order_id)
+                rows.append((order_id, import_field(record, "customer") or None, amount))
+        await conn.executemany(
+            "INSERT INTO orders (fanpay_order_id, customer_info, amount, status) VALUES (?, ?, ?, 'pending')", rows
+        )
+        result.accepted["order"] += len(rows)
+
+async def import_records(records) -> ImportResult:
+    result = ImportResult()
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await import_chunk(result, chunk)
+            chunk = []
+    if chunk:
+        await import_chunk(result, chunk)
+    for telegram_id in result.telegram_ids:
+        escort_cache.invalidate(telegram_id)
+    stats_cache.invalidate()
+    return result
+
+@dp.message(Command("import"), flags={"admin_only": True})
+async def cmd_import(message: types.Message, state: FSMContext):
+    await message.answer(IMPORT_HELP, reply_markup=ReplyKeyboardRemove())
+    await state.set_state(Form.import_file)
+
+@dp.message(Form.import_file)
+async def process_import_file(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    try:
+        document = message.document
+        if document is None:
+            await message.answer(MESSAGES["invalid_format"], reply_markup=get_admin_keyboard())
+            return
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            await message.answer("❌ Файл больше 20 МБ — разделите его на части.", reply_markup=get_admin_keyboard())
+            return
+        buffer = await bot.download(document)
+        result = await import_records(iter_import_records(buffer, document.file_name or ""))
+        await message.answer(result.summary(), reply_markup=get_admin_keyboard())
+        total = sum(result.accepted.values())
+        logger.info(f"Импорт {document.file_name} администратором {user_id}: принято {total}, отклонено {result.rejected}")
+        if total:
+            notify_admins(
+                f"📥 Импорт: сквадов {result.accepted['squad']}, сопровождающих {result.accepted['escort']}, "
+                f"заказов {result.accepted['order']}"
+            )
+    except UnicodeDecodeError:
+        await message.answer("❌ Файл должен быть в кодировке UTF-8.", reply_markup=get_admin_keyboard())
+    except Exception as e:
+        logger.error(f"Ошибка в process_import_file для {user_id}: {e}")
+        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
+    finally:
+        await state.clear()
 
+# --- Команда /stats для общей статистики ---
+@dp.message(Command("stats"), flags={"admin_only": True})
+async def cmd_stats(message: types.Message):
+    try:
+        stats = await stats_cache.get()
         response = (
             "📊 Общая статистика бота:\n"
-            f"👥 Сопровождающих: {total_escorts}\n"
-            f"🏠 Сквадов: {total_squads}\n"
-            f"✅ Завершённых заказов: {completed_orders}\n"
-            f"💰 Общий заработок: {total_earnings:.2f} руб.\n"
-            f"🌟 Средний рейтинг заказов: {avg_rating:.2f} ⭐"
+            f"👥 Сопровождающих: {stats['escorts']}\n"
+            f"🏠 Сквадов: {len(stats['squads'])}\n"
+            f"✅ Завершённых заказов: {stats['completed_orders']}\n"
+            f"💰 Общий заработок: {stats['total_earnings']:.2f} руб.\n"
+            f"🌟 Средний рейтинг заказов: {stats['avg_rating']:.2f} ⭐"
         )
         await message.answer(response, reply_markup=get_admin_keyboard())
     except Exception as e:
         logger.error(f"Ошибка в cmd_stats для {message.from_user.id}: {e}")
         await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
 
+# --- Команда /cache для статистики кэша профилей ---
+@dp.message(Command("cache"), flags={"admin_only": True})
+async def cmd_cache(message: types.Message):
+    stats = escort_cache.stats()
+    response = (
+        "🗄 Кэш профилей:\n"
+        f"📦 Записей: {stats['size']}/{escort_cache.max_size}\n"
+        f"✅ Попаданий: {stats['hits']}\n"
+        f"❌ Промахов: {stats['misses']}\n"
+        f"📈 Доля попаданий: {stats['hit_rate']:.1%}\n"
+        f"🔐 Проверок доступа: {access_middleware.checks}, "
+        f"среднее {access_middleware.total_time / max(access_middleware.checks, 1) * 1000:.2f} мс, "
+        f"макс. {access_middleware.max_time * 1000:.2f} мс"
+    )
+    await message.answer(response, reply_markup=get_admin_keyboard())
+
+# --- Команда /queries для отчёта по запросам к БД ---
+@dp.message(Command("queries"), flags={"admin_only": True})
+async def cmd_queries(message: types.Message):
+    report = query_report()
+    if not report:
+        await message.answer("📭 Запросов к БД пока не было.", reply_markup=get_admin_keyboard())
+        return
+    response = f"🐢 Запросы к БД по суммарному времени (порог медленных {SLOW_QUERY_MS:g} мс):\n"
+    for position, stat in enumerate(report[:10], start=1):
+        sources = ", ".join(f"{name} ({count})" for name, count in sorted(stat.sources.items(), key=lambda item: -item[1])[:3])
+        entry = (
+            f"\n{position}. {stat.count}× ср. {stat.total / stat.count * 1000:.2f} мс, "
+            f"макс. {stat.max * 1000:.2f} мс, строк {stat.rows}, медленных {stat.slow}\n"
+            f"{stat.sql[:200]}\n"
+            f"Источники: {sources}\n"
+        )
+        entry += "".join(f"⚠️ {flag}\n" for flag in stat.flags)
+        if len(response) + len(entry) > 4096:
+            break
+        response += entry
+    await message.answer(response, reply_markup=get_admin_keyboard())
+    # Полный отчёт JSON-файлом: только администраторам, без открытого HTTP-маршрута
+    dump = json.dumps([stat.as_dict() for stat in report], ensure_ascii=False, indent=2)
+    await message.answer_document(types.BufferedInputFile(dump.encode("utf-8"), filename="queries.json"))
+
 # --- Запуск бота ---
+def setup_webhook(app: web.Application) -> str:
+    secret = WEBHOOK_SECRET
+    if not secret:
+        # Случайный секрет годится для одного процесса; несколько экземпляров за прокси
+        # должны получать общий WEBHOOK_SECRET, иначе перезапишут секрет друг друга
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан, используется случайный секрет")
+    # Telegram передаёт секрет в X-Telegram-Bot-Api-Secret-Token; чужие запросы получают 401
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return secret
+
 async def main():
+    runner = None
     try:
-        # Настройка веб-сервера для пинга
+        # Инициализация базы данных до приёма обновлений
+        await db.open()
+        await init_db()
+        # Доставка уведомлений, оставшихся в outbox с прошлого запуска, и новых
+        outbox.start()
+        await sanction_sweeper.start()
+
+        # Веб-сервер: пинг, метрики и, в режиме вебхука, приём обновлений от Telegram
         app = web.Application()
         app.router.add_get('/ping', ping)
+        app.router.add_get('/metrics', metrics_endpoint)
+        if WEBHOOK_URL:
+            secret = setup_webhook(app)
         runner = web.AppRunner(app)
         await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', 8080)
+        site = web.TCPSite(runner, '0.0.0.0', WEB_PORT)
         await site.start()
-        logger.info("Веб-сервер запущен на порту 8080")
-
-        # Инициализация базы данных
-        await init_db()
+        logger.info(f"Веб-сервер запущен на порту {WEB_PORT}")
 
         # Запуск бота
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            # Вебхук регистрируется только после того, как сервер готов принимать запросы
+            await bot.set_webhook(
+                f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                secret_token=secret,
+                allowed_updates=used_update_types(),
+            )
+            logger.info(f"Вебхук установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+            await asyncio.Event().wait()
+        else:
+            # getUpdates не работает при установленном вебхуке: снимаем его перед polling
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=used_update_types())
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
     finally:
+        if runner is not None:
+            await runner.cleanup()
+        await sanction_sweeper.close()
+        await callback_pipeline.close()
+        await lobbies.flush()
+        await outbox.close()
+        await broadcaster.close()
+        await db.close()
         await bot.session.close()
 
 if __name__ == "__main__":